@@ -0,0 +1,351 @@
+"""Нагрузочный тест бота без сети.
+
+Поднимает локальные заглушки OpenRouter (/api/v1/chat/completions) и
+Telegram Bot API, подаёт синтетические апдейты в настоящие обработчики
+из main.py и пишет JSON-отчёт: пропускная способность, задержки
+p50/p95/p99, зависания event loop и пиковая память.
+
+Пример:
+    python benchmark.py --users 200 --messages 5 --latency 0.5 --output before.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+from aiohttp import web
+
+STUB_TOKEN = '123456:BENCHMARK'
+STUB_BOT_ID = 123456
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн нагрузочный тест бота")
+    parser.add_argument('--users', type=int, default=50, help="Одновременных пользователей")
+    parser.add_argument('--messages', type=int, default=5, help="Апдейтов от каждого пользователя")
+    parser.add_argument('--think-time', type=float, default=0.0, help="Пауза пользователя между сообщениями, с")
+    parser.add_argument('--latency', type=float, default=0.3, help="Средняя задержка заглушки OpenRouter, с")
+    parser.add_argument('--jitter', type=float, default=0.1, help="Разброс задержки, с")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Доля ответов 500 от заглушки")
+    parser.add_argument('--stream-chunks', type=int, default=20, help="Фрагментов в потоковом ответе")
+    parser.add_argument('--reply-chars', type=int, default=400, help="Длина ответа модели")
+    parser.add_argument('--streaming', choices=('on', 'off'), default='on', help="Потоковые ответы бота")
+    parser.add_argument('--command-ratio', type=float, default=0.2, help="Доля лёгких команд")
+    parser.add_argument('--voice-ratio', type=float, default=0.0, help="Доля /voice")
+    parser.add_argument('--tts-latency', type=float, default=0.2, help="Имитация gTTS + перекодирования, с")
+    parser.add_argument('--stall-threshold', type=float, default=0.05, help="Порог зависания event loop, с")
+    parser.add_argument('--timeout', type=float, default=120.0, help="Максимум ожидания одного апдейта, с")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench_report.json', help="Файл JSON-отчёта")
+    return parser.parse_args(argv)
+
+# ==================== ЗАГЛУШКА OPENROUTER ====================
+class OpenRouterStub:
+    """Отвечает как /api/v1/chat/completions с заданной задержкой и долей ошибок"""
+
+    def __init__(self, args):
+        self.args = args
+        self.requests = 0
+        self.errors = 0
+        self.streams = 0
+
+    def _delay(self) -> float:
+        return max(0.0, random.gauss(self.args.latency, self.args.jitter))
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        data = await request.json()
+        self.requests += 1
+        if random.random() < self.args.error_rate:
+            self.errors += 1
+            await asyncio.sleep(self._delay() / 2)
+            return web.json_response({'error': {'message': 'stub failure'}}, status=500)
+
+        text = ('Это ответ заглушки. ' * (self.args.reply_chars // 20 + 1))[:self.args.reply_chars]
+        usage = {'prompt_tokens': sum(len(m['content']) for m in data['messages']) // 3,
+                 'completion_tokens': len(text) // 3}
+        if not data.get('stream'):
+            await asyncio.sleep(self._delay())
+            return web.json_response({
+                'model': data['model'],
+                'choices': [{'message': {'role': 'assistant', 'content': text}}],
+                'usage': usage
+            })
+
+        self.streams += 1
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        chunks = max(1, self.args.stream_chunks)
+        step = len(text) // chunks + 1
+        pause = self._delay() / chunks
+        await response.write(b': OPENROUTER PROCESSING\n\n')
+        for start in range(0, len(text), step):
+            await asyncio.sleep(pause)
+            chunk = {'choices': [{'delta': {'content': text[start:start + step]}}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+        await response.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode('utf-8'))
+        await response.write(b'data: [DONE]\n\n')
+        return response
+
+# ==================== ЗАГЛУШКА TELEGRAM BOT API ====================
+class TelegramStub:
+    """Минимальный Bot API: отвечает на методы, которые вызывает бот"""
+
+    def __init__(self):
+        self.calls = {}
+        self._message_id = 0
+
+    def _message(self, chat_id, text: str = None) -> dict:
+        self._message_id += 1
+        message = {
+            'message_id': self._message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'}
+        }
+        if text is not None:
+            message['text'] = text
+        return message
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = dict(await request.post())
+
+        if method == 'getMe':
+            result = {'id': STUB_BOT_ID, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot',
+                      'can_join_groups': True, 'can_read_all_group_messages': False,
+                      'supports_inline_queries': False}
+        elif method in ('sendMessage', 'editMessageText'):
+            result = self._message(params.get('chat_id', 0), params.get('text', ''))
+        elif method in ('sendVoice', 'sendAudio', 'sendDocument'):
+            result = self._message(params.get('chat_id', 0))
+        else:
+            # sendChatAction, deleteWebhook, setMyCommands и прочее
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+async def start_server(routes) -> tuple:
+    """Запускает aiohttp-сервер на свободном порту, возвращает (runner, порт)"""
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    for method, path, handler in routes:
+        app.router.add_route(method, path, handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, port
+
+# ==================== ИМИТАЦИЯ TTS ====================
+TTS_LATENCY = 0.2
+
+def fake_fetch_mp3(text: str, lang: str) -> bytes:
+    """Вместо похода в gTTS - пауза и фиктивные байты"""
+    time.sleep(TTS_LATENCY / 2)
+    return f"{lang}:{text}".encode('utf-8')
+
+def fake_transcode_to_ogg(mp3_data: bytes) -> bytes:
+    """Вместо ffmpeg - занятый процессор на время перекодирования"""
+    deadline = time.perf_counter() + TTS_LATENCY / 2
+    while time.perf_counter() < deadline:
+        pass
+    return b'OggS' + mp3_data
+
+# ==================== СИНТЕТИЧЕСКИЕ АПДЕЙТЫ ====================
+COMMANDS = ('/help', '/models', '/current', '/stats')
+QUESTIONS = ('привет', 'что ты умеешь', 'расскажи про Python', 'как дела?',
+             'напиши функцию сортировки', 'объясни рекурсию')
+
+def make_update_payload(update_id: int, user_id: int, text: str) -> dict:
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+        'text': text
+    }
+    if text.startswith('/'):
+        command = text.split(maxsplit=1)[0]
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+    return {'update_id': update_id, 'message': message}
+
+def pick_text(args) -> tuple:
+    roll = random.random()
+    if roll < args.voice_ratio:
+        return 'voice', f"/voice {random.choice(QUESTIONS)}"
+    if roll < args.voice_ratio + args.command_ratio:
+        return 'command', random.choice(COMMANDS)
+    return 'text', random.choice(QUESTIONS)
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {'count': 0}
+    ordered = sorted(values)
+
+    def at(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 4)
+
+    return {
+        'count': len(ordered),
+        'mean': round(sum(ordered) / len(ordered), 4),
+        'p50': at(0.50),
+        'p95': at(0.95),
+        'p99': at(0.99),
+        'max': round(ordered[-1], 4)
+    }
+
+class LoopStallMonitor:
+    """Замечает моменты, когда event loop просыпается позже, чем должен"""
+
+    def __init__(self, threshold: float, interval: float = 0.01):
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = 0
+        self.max_lag = 0.0
+        self.total_stall_time = 0.0
+
+    async def run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - started - self.interval
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.threshold:
+                self.stalls += 1
+                self.total_stall_time += lag
+
+def peak_rss_mb() -> dict:
+    # На Linux ru_maxrss в килобайтах
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {'self': round(own / 1024, 1), 'children': round(children / 1024, 1)}
+
+# ==================== ПРОГОН ====================
+async def run_benchmark(args) -> dict:
+    random.seed(args.seed)
+    openrouter = OpenRouterStub(args)
+    telegram = TelegramStub()
+    openrouter_runner, openrouter_port = await start_server([
+        ('POST', '/api/v1/chat/completions', openrouter.handle)
+    ])
+    telegram_runner, telegram_port = await start_server([
+        ('POST', '/bot{token}/{method}', telegram.handle),
+        ('GET', '/bot{token}/{method}', telegram.handle)
+    ])
+
+    # Настройки читаются при импорте main, поэтому задаём их заранее
+    os.environ['OPENROUTER_URL'] = f"http://127.0.0.1:{openrouter_port}/api/v1/chat/completions"
+    os.environ['STREAMING_ENABLED'] = '1' if args.streaming == 'on' else '0'
+    # Имитация перекодирования подменяет путь через пул процессов, а не ffmpeg
+    os.environ['TTS_TRANSCODER'] = 'pydub'
+    import main
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    main.openrouter_client.url = os.environ['OPENROUTER_URL']
+    main.openrouter_client.api_key = 'benchmark'
+    global TTS_LATENCY
+    TTS_LATENCY = args.tts_latency
+    main._fetch_mp3 = fake_fetch_mp3
+    main._transcode_to_ogg = fake_transcode_to_ogg
+
+    application = main.build_application(
+        STUB_TOKEN,
+        base_url=f"http://127.0.0.1:{telegram_port}/bot",
+        base_file_url=f"http://127.0.0.1:{telegram_port}/file/bot"
+    )
+
+    # Группа после основных обработчиков: апдейт обработан целиком
+    pending = {}
+
+    async def mark_done(update, context):
+        future = pending.pop(update.update_id, None)
+        if future is not None and not future.done():
+            future.set_result(time.perf_counter())
+
+    application.add_handler(TypeHandler(Update, mark_done), group=99)
+
+    monitor = LoopStallMonitor(args.stall_threshold)
+    monitor_task = asyncio.create_task(monitor.run())
+
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+
+    latencies = {'text': [], 'command': [], 'voice': []}
+    timeouts = 0
+    next_update_id = 0
+
+    async def simulate_user(user_id: int):
+        nonlocal next_update_id, timeouts
+        for _ in range(args.messages):
+            kind, text = pick_text(args)
+            next_update_id += 1
+            update = Update.de_json(make_update_payload(next_update_id, user_id, text), application.bot)
+            future = asyncio.get_running_loop().create_future()
+            pending[update.update_id] = future
+            sent_at = time.perf_counter()
+            await application.update_queue.put(update)
+            try:
+                done_at = await asyncio.wait_for(future, timeout=args.timeout)
+                latencies[kind].append(done_at - sent_at)
+            except asyncio.TimeoutError:
+                timeouts += 1
+                pending.pop(update.update_id, None)
+            if args.think_time:
+                await asyncio.sleep(random.expovariate(1 / args.think_time))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(simulate_user(1000 + index) for index in range(args.users)))
+    elapsed = time.perf_counter() - started
+
+    monitor_task.cancel()
+    await application.stop()
+    await application.shutdown()
+    await application.post_shutdown(application)
+    await openrouter_runner.cleanup()
+    await telegram_runner.cleanup()
+
+    completed = sum(len(values) for values in latencies.values())
+    return {
+        'config': vars(args),
+        'elapsed_seconds': round(elapsed, 3),
+        'updates_completed': completed,
+        'updates_timed_out': timeouts,
+        'throughput_updates_per_second': round(completed / elapsed, 2) if elapsed else 0.0,
+        'latency_seconds': {
+            'all': percentiles([value for values in latencies.values() for value in values]),
+            **{kind: percentiles(values) for kind, values in latencies.items()}
+        },
+        'event_loop': {
+            'stalls': monitor.stalls,
+            'stall_threshold_seconds': args.stall_threshold,
+            'total_stall_seconds': round(monitor.total_stall_time, 4),
+            'max_lag_seconds': round(monitor.max_lag, 4)
+        },
+        'peak_rss_mb': peak_rss_mb(),
+        'openrouter_stub': {
+            'requests': openrouter.requests,
+            'errors': openrouter.errors,
+            'streams': openrouter.streams
+        },
+        'telegram_api_calls': telegram.calls
+    }
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(run_benchmark(args))
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    latency = report['latency_seconds']['all']
+    print(f"✅ {report['updates_completed']} апдейтов за {report['elapsed_seconds']} c "
+          f"({report['throughput_updates_per_second']}/c)")
+    print(f"⏱ p50={latency.get('p50')} p95={latency.get('p95')} p99={latency.get('p99')} c, "
+          f"зависаний loop: {report['event_loop']['stalls']}, RSS: {report['peak_rss_mb']['self']} МБ")
+    print(f"📄 Отчёт: {args.output}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,127 +1,2601 @@
+from __future__ import annotations
+
+import time
+_PROCESS_STARTED = time.perf_counter()
+
 import os
 import logging
-import requests
+import logging.handlers
+import queue
+import atexit
 import io
-import aiohttp
-import time
+import importlib
 import threading
 import asyncio
+import json
+import hashlib
+import tempfile
+import sqlite3
+import hmac
+import signal
+import bisect
+import functools
+import multiprocessing
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime
-from gtts import gTTS
-from pydub import AudioSegment
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from flask import Flask
+from telegram import Bot, Update
+from telegram.error import BadRequest, Conflict, InvalidToken, NetworkError, RetryAfter, TelegramError
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, filters, ContextTypes
+
+# ==================== ЛЕНИВАЯ ЗАГРУЗКА ====================
+class LazyModule:
+    """Модуль, который импортируется при первом обращении к его атрибуту.
+
+    Тяжёлые зависимости (aiohttp, gTTS, pydub, Flask) не нужны, чтобы
+    начать принимать апдейты, и не должны задерживать запуск процесса.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._module is not None
+
+    def load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+aiohttp = LazyModule('aiohttp')
+web = LazyModule('aiohttp.web')
+
+class StartupReport:
+    """Длительность фаз запуска и готовность принимать трафик.
+
+    mark() записывает время, прошедшее с предыдущей отметки, поэтому фазы
+    основного пути идут подряд. Фоновый прогрев пишется через record().
+    """
+
+    def __init__(self, started: float):
+        self.started = started
+        self.phases = {}
+        self.ready = False
+        self.ready_after = None
+        self._last = started
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases[phase] = round(now - self._last, 4)
+        self._last = now
+
+    def record(self, phase: str, seconds: float):
+        self.phases[phase] = round(seconds, 4)
+
+    def set_ready(self):
+        self.ready = True
+        if self.ready_after is None:
+            self.ready_after = round(time.perf_counter() - self.started, 4)
+            report = ', '.join(f"{phase} {seconds * 1000:.0f} мс" for phase, seconds in self.phases.items())
+            logger.info(f"🚦 Готов к работе через {self.ready_after * 1000:.0f} мс: {report}")
+
+    def set_not_ready(self):
+        self.ready = False
+
+    def as_dict(self) -> dict:
+        return {"ready": self.ready, "ready_after": self.ready_after, "phases": dict(self.phases)}
+
+startup = StartupReport(_PROCESS_STARTED)
+startup.mark('imports')
+
+# ==================== КОНФИГУРАЦИЯ ====================
+# Настройка продвинутого логирования
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FILE = os.getenv('LOG_FILE', 'bot.log')
+LOG_ROTATE = os.getenv('LOG_ROTATE', 'size')  # size или time
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN', 'midnight')
+LOG_BACKUPS = int(os.getenv('LOG_BACKUPS', '5'))
+LOG_JSON = os.getenv('LOG_JSON', '0') == '1'
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_SAMPLE_BURST = int(os.getenv('LOG_SAMPLE_BURST', '20'))  # Строк с одного места за окно, 0 - без выборки
+LOG_SAMPLE_WINDOW = float(os.getenv('LOG_SAMPLE_WINDOW', '10'))  # Секунд
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись - для сборщиков логов"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class SamplingFilter(logging.Filter):
+    """Пропускает не больше burst записей с одного места в коде за окно.
+
+    Предупреждения и ошибки проходят всегда. Число отброшенных строк
+    дописывается к первой записи следующего окна.
+    """
+
+    def __init__(self, burst: int = LOG_SAMPLE_BURST, window: float = LOG_SAMPLE_WINDOW):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.dropped_total = 0
+        self._sites = {}  # (файл, строка) -> [начало окна, пропущено, отброшено]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.burst <= 0 or record.levelno >= logging.WARNING:
+            return True
+        key = (record.pathname, record.lineno)
+        now = record.created
+        site = self._sites.get(key)
+        if site is None or now - site[0] >= self.window:
+            dropped = site[2] if site else 0
+            self._sites[key] = [now, 1, 0]
+            if dropped:
+                record.msg = f"{record.getMessage()} (пропущено похожих: {dropped})"
+                record.args = None
+            return True
+        if site[1] < self.burst:
+            site[1] += 1
+            return True
+        site[2] += 1
+        self.dropped_total += 1
+        return False
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Кладёт запись в очередь и сразу возвращается; при переполнении - отбрасывает"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Очередь внутри процесса: форматированием займётся поток записи
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Логирование через очередь: обработчики только ставят запись в очередь,
+    а форматирование, запись в файл с ротацией и в консоль - в фоновом потоке"""
+    formatter = JsonFormatter() if LOG_JSON else logging.Formatter(LOG_FORMAT)
+    if LOG_ROTATE == 'time':
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUPS, encoding='utf-8'
+        )
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8'
+        )
+    output_handlers = [logging.StreamHandler(), file_handler]
+    for handler in output_handlers:
+        handler.setFormatter(formatter)
+    
+    queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    queue_handler.addFilter(SamplingFilter())
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.handlers = [queue_handler]
+    
+    listener = logging.handlers.QueueListener(queue_handler.queue, *output_handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
+logger = logging.getLogger(__name__)
+
+# Получаем токены
+TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
+OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY')
+
+# Настройки подключения к OpenRouter
+OPENROUTER_URL = os.getenv('OPENROUTER_URL', 'https://openrouter.ai/api/v1/chat/completions')
+OPENROUTER_MAX_CONNECTIONS = int(os.getenv('OPENROUTER_MAX_CONNECTIONS', '100'))  # На один хост
+OPENROUTER_CONNECT_TIMEOUT = float(os.getenv('OPENROUTER_CONNECT_TIMEOUT', '5'))
+OPENROUTER_READ_TIMEOUT = float(os.getenv('OPENROUTER_READ_TIMEOUT', '30'))
+OPENROUTER_KEEPALIVE = float(os.getenv('OPENROUTER_KEEPALIVE', '60'))
+
+# Потоковые ответы: сообщение редактируется по мере генерации
+STREAMING_ENABLED = os.getenv('STREAMING_ENABLED', '1') == '1'
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))  # Секунд между правками
+STREAM_EDIT_MIN_CHARS = int(os.getenv('STREAM_EDIT_MIN_CHARS', '40'))  # Минимум новых символов
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Кэш ответов моделей на повторяющиеся вопросы
+RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', '0') == '1'
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '3600'))  # Секунд
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+
+# Защита от сбоев моделей: лимит запросов, предохранитель и запасные модели
+MODEL_RATE_LIMIT = float(os.getenv('MODEL_RATE_LIMIT', '10'))  # Запросов в секунду на модель
+MODEL_RATE_BURST = int(os.getenv('MODEL_RATE_BURST', '20'))
+MODEL_RATE_WAIT = float(os.getenv('MODEL_RATE_WAIT', '2'))  # Секунд ждать лимит выбранной модели, потом - запасная
+MODEL_FALLBACK_CHAIN = os.getenv('MODEL_FALLBACK_CHAIN', 'deepseek,gpt,claude,gemini,deepseek-coder')
+BREAKER_WINDOW = float(os.getenv('BREAKER_WINDOW', '60'))  # Секунд статистики
+BREAKER_MIN_REQUESTS = int(os.getenv('BREAKER_MIN_REQUESTS', '5'))
+BREAKER_ERROR_RATE = float(os.getenv('BREAKER_ERROR_RATE', '0.5'))
+BREAKER_SLOW_CALL = float(os.getenv('BREAKER_SLOW_CALL', '20'))  # Секунд - медленный ответ
+BREAKER_SLOW_RATE = float(os.getenv('BREAKER_SLOW_RATE', '0.8'))
+BREAKER_COOLDOWN = float(os.getenv('BREAKER_COOLDOWN', '30'))  # Секунд до пробного запроса
+HEDGE_ENABLED = os.getenv('HEDGE_ENABLED', '0') == '1'  # Дублировать запрос после p95
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', '20'))
+
+# Исходящие сообщения: лимиты Telegram (~30 в секунду всего, ~1 в секунду на чат)
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', '30'))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', '1'))
+SEND_CHAT_BURST = int(os.getenv('SEND_CHAT_BURST', '3'))
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', '5'))  # Повторов после RetryAfter
+CHAT_ACTION_TTL = 4.5  # Telegram показывает "печатает..." около 5 секунд
+TELEGRAM_CAPTION_LIMIT = 1024
+
+# Синтез речи: пулы воркеров и кэш готового аудио
+TTS_FETCH_WORKERS = int(os.getenv('TTS_FETCH_WORKERS', '4'))  # Потоки для запросов к gTTS
+TTS_TRANSCODE_WORKERS = int(os.getenv('TTS_TRANSCODE_WORKERS', '2'))  # Процессы для ffmpeg
+TTS_TRANSCODER = os.getenv('TTS_TRANSCODER', 'ffmpeg')  # ffmpeg (тёплый пул, Opus) или pydub
+TTS_OPUS_BITRATE = os.getenv('TTS_OPUS_BITRATE', '32k')
+TTS_TRANSCODE_TIMEOUT = float(os.getenv('TTS_TRANSCODE_TIMEOUT', '30'))
+TTS_MAX_PENDING = int(os.getenv('TTS_MAX_PENDING', '16'))  # Больше - сразу отказываем
+TTS_CACHE_MAX_BYTES = int(os.getenv('TTS_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+TTS_CACHE_DIR = os.getenv('TTS_CACHE_DIR')  # Необязательный дисковый кэш
+TTS_CACHE_DISK_MAX_BYTES = int(os.getenv('TTS_CACHE_DISK_MAX_BYTES', str(256 * 1024 * 1024)))
+
+# История диалогов: сколько помнить и сколько отправлять модели
+HISTORY_MAX_TURNS = int(os.getenv('HISTORY_MAX_TURNS', '20'))
+HISTORY_MAX_TOKENS = int(os.getenv('HISTORY_MAX_TOKENS', '4000'))  # Примерно, на пользователя
+HISTORY_CONTEXT_TURNS = int(os.getenv('HISTORY_CONTEXT_TURNS', '6'))  # Последних K реплик в запросе
+HISTORY_CONTEXT_TOKENS = int(os.getenv('HISTORY_CONTEXT_TOKENS', '2000'))
+HISTORY_IDLE_TTL = float(os.getenv('HISTORY_IDLE_TTL', str(6 * 3600)))  # Забываем молчащих
+
+# Голосовые сообщения: ограничения и распознавание речи
+VOICE_MAX_DURATION = float(os.getenv('VOICE_MAX_DURATION', '60'))  # Секунд
+VOICE_MAX_FILE_SIZE = int(os.getenv('VOICE_MAX_FILE_SIZE', str(2 * 1024 * 1024)))
+VOICE_MAX_CONCURRENT = int(os.getenv('VOICE_MAX_CONCURRENT', '4'))  # Одновременных распознаваний
+VOICE_TIMEOUT = float(os.getenv('VOICE_TIMEOUT', '60'))
+STT_BACKEND = os.getenv('STT_BACKEND', 'vosk')  # vosk или stub
+VOSK_MODEL_PATH = os.getenv('VOSK_MODEL_PATH', 'model')  # Распакованная модель с alphacephei.com/vosk/models
+FFMPEG_BINARY = os.getenv('FFMPEG_BINARY', 'ffmpeg')
+
+# Хранилище состояния: memory (по умолчанию) или sqlite
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory')
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', 'bot_state.db')
+STATE_FLUSH_INTERVAL = float(os.getenv('STATE_FLUSH_INTERVAL', '5'))  # Секунд между записями
+STATE_FLUSH_BATCH = int(os.getenv('STATE_FLUSH_BATCH', '500'))  # Записать раньше, если накопилось
+
+# Режим получения апдейтов: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+HTTP_PORT = int(os.getenv('PORT', '5000'))
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')  # Проверяется в X-Telegram-Bot-Api-Secret-Token
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '1000'))  # 0 - без ограничения
+
+# Параллельная обработка апдейтов: порядок сохраняется только внутри чата
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '32'))  # Одновременных LLM/TTS-задач
+MAX_PENDING_UPDATES = int(os.getenv('MAX_PENDING_UPDATES', '10000'))  # Всего апдейтов в работе
+FAST_LANE_COMMANDS = frozenset({'help', 'models', 'current', 'stats'})  # Не ждут очереди
+
+# Склейка сообщений, отправленных подряд, в один запрос к модели (0 - выключено)
+DEBOUNCE_WINDOW = float(os.getenv('DEBOUNCE_WINDOW_MS', '0')) / 1000  # Пауза, после которой пачка уходит
+DEBOUNCE_MAX_WAIT = float(os.getenv('DEBOUNCE_MAX_WAIT_MS', '3000')) / 1000  # Не дольше от первого сообщения
+DEBOUNCE_MAX_BATCH = int(os.getenv('DEBOUNCE_MAX_BATCH', '5'))  # Сообщений в пачке
+
+# Масштабирование на несколько процессов: апдейты делятся между воркерами по user_id
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '1'))  # 1 - всё в одном процессе
+WORKER_QUEUE_SIZE = int(os.getenv('WORKER_QUEUE_SIZE', '1000'))  # Апдейтов в очереди воркера
+WORKER_BUFFER_SIZE = int(os.getenv('WORKER_BUFFER_SIZE', '10000'))  # Апдейтов в буфере ingress сверх очереди
+WORKER_RESTART_MAX_BACKOFF = float(os.getenv('WORKER_RESTART_MAX_BACKOFF', '60'))  # Потолок паузы перед перезапуском
+WORKER_HEARTBEAT_INTERVAL = float(os.getenv('WORKER_HEARTBEAT_INTERVAL', '5'))
+WORKER_HEARTBEAT_TIMEOUT = float(os.getenv('WORKER_HEARTBEAT_TIMEOUT', '30'))  # Потом перезапуск
+WORKER_DRAIN_TIMEOUT = float(os.getenv('WORKER_DRAIN_TIMEOUT', '30'))  # Секунд на дообработку при остановке
+POLL_MAX_BACKOFF = float(os.getenv('POLL_MAX_BACKOFF', '30'))  # Потолок паузы между неудачными getUpdates
+POLL_RESTART_DELAY = float(os.getenv('POLL_RESTART_DELAY', '5'))  # Пауза перед перезапуском упавшего polling
+WORKER_SHARD = None  # (номер, всего) внутри процесса-воркера
+
+# Прогрев TTS, STT и клиента OpenRouter в фоне, когда бот уже принимает апдейты
+STARTUP_PREWARM = os.getenv('STARTUP_PREWARM', '1') == '1'
+
+# ==================== СИСТЕМА ПАМЯТИ ====================
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов без токенизатора"""
+    return len(text) // 3 + 1
+
+class Turn:
+    """Одна реплика диалога: вопрос и ответ"""
+    __slots__ = ('question', 'answer', 'tokens', 'timestamp')
+
+    def __init__(self, question: str, answer: str, timestamp: float):
+        self.question = question
+        self.answer = answer
+        self.tokens = estimate_tokens(question) + estimate_tokens(answer)
+        self.timestamp = timestamp
+
+class ConversationMemory:
+    """История диалогов с ограничением по числу реплик и токенов.
+
+    Для каждого пользователя хранится кольцевой буфер последних реплик;
+    пользователи, молчащие дольше idle_ttl, забываются целиком.
+    """
+
+    def __init__(self, max_turns: int = HISTORY_MAX_TURNS,
+                 max_tokens: int = HISTORY_MAX_TOKENS,
+                 idle_ttl: float = HISTORY_IDLE_TTL):
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.idle_ttl = idle_ttl
+        self._turns = {}  # user_id -> deque[Turn]
+        self._tokens = {}  # user_id -> сумма токенов в буфере
+        self._last_sweep = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._turns)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._turns
+
+    def turns(self, user_id: int) -> list:
+        return list(self._turns.get(user_id, ()))
+
+    def append(self, user_id: int, question: str, answer: str, timestamp: float = None):
+        """Запоминает реплику, вытесняя самые старые при переполнении.
+
+        timestamp - время реплики по time.monotonic(), по умолчанию - сейчас.
+        """
+        now = time.monotonic() if timestamp is None else timestamp
+        turns = self._turns.get(user_id)
+        if turns is None:
+            turns = self._turns[user_id] = deque(maxlen=self.max_turns)
+            self._tokens[user_id] = 0
+        if len(turns) == turns.maxlen:
+            self._tokens[user_id] -= turns[0].tokens
+        turn = Turn(question, answer, now)
+        turns.append(turn)
+        self._tokens[user_id] += turn.tokens
+        while len(turns) > 1 and self._tokens[user_id] > self.max_tokens:
+            self._tokens[user_id] -= turns.popleft().tokens
+        
+        if now - self._last_sweep > self.idle_ttl / 10:
+            self.evict_idle(now)
+
+    def evict_idle(self, now: float = None):
+        """Забывает пользователей, которые давно не писали"""
+        now = time.monotonic() if now is None else now
+        self._last_sweep = now
+        idle = [
+            user_id for user_id, turns in self._turns.items()
+            if now - turns[-1].timestamp > self.idle_ttl
+        ]
+        for user_id in idle:
+            self.forget(user_id)
+        return len(idle)
+
+    def forget(self, user_id: int):
+        self._turns.pop(user_id, None)
+        self._tokens.pop(user_id, None)
+
+    def build_messages(self, user_id: int, user_message: str, model_key: str,
+                       max_tokens: int) -> list:
+        """Собирает messages для OpenRouter из последних реплик, влезающих в контекст модели"""
+        context_tokens = AVAILABLE_MODELS[model_key].get('context_tokens', 4096)
+        budget = min(
+            HISTORY_CONTEXT_TOKENS,
+            context_tokens - max_tokens - estimate_tokens(user_message)
+        )
+        
+        selected = []
+        for turn in reversed(self._turns.get(user_id, ())):
+            if len(selected) >= HISTORY_CONTEXT_TURNS or turn.tokens > budget:
+                break
+            budget -= turn.tokens
+            selected.append(turn)
+        
+        messages = []
+        for turn in reversed(selected):
+            messages.append({'role': 'user', 'content': turn.question})
+            messages.append({'role': 'assistant', 'content': turn.answer})
+        messages.append({'role': 'user', 'content': user_message})
+        return messages
+
+class UserStats:
+    """Снимок статистики одного пользователя; времена - секунды эпохи"""
+
+    __slots__ = ('first_seen', 'message_count', 'last_active')
+
+    def __init__(self, first_seen: int, message_count: int, last_active: int):
+        self.first_seen = first_seen
+        self.message_count = message_count
+        self.last_active = last_active
+
+class RingCounter:
+    """Счётчик событий по временным корзинам фиксированной ширины"""
+
+    def __init__(self, width: int, slots: int):
+        self.width = width
+        self._counts = array('q', bytes(8 * slots))
+        self._stamps = array('q', [-1]) * slots
+
+    def add(self, now: int, amount: int = 1):
+        bucket = now // self.width
+        slot = bucket % len(self._counts)
+        if self._stamps[slot] != bucket:
+            self._stamps[slot] = bucket
+            self._counts[slot] = 0
+        self._counts[slot] += amount
+
+    def series(self, now: int) -> list:
+        """Значения корзин от самой старой к текущей"""
+        current = now // self.width
+        size = len(self._counts)
+        return [
+            self._counts[bucket % size] if self._stamps[bucket % size] == bucket else 0
+            for bucket in range(current - size + 1, current + 1)
+        ]
+
+class UserStatsStore:
+    """Компактная статистика пользователей с инкрементальными агрегатами.
+
+    Поля пользователей лежат в трёх массивах int64, user_id -> номер строки
+    в словаре. Агрегаты обновляются за O(1) на сообщение:
+    - активные пользователи: каждый учтён в корзине минуты, часа и дня своей
+      последней активности, при новой активности он переезжает в текущие;
+    - поток сообщений по минутам и по часам в кольцевых счётчиках;
+    - ответы по моделям.
+    Сводка для /stats обходит фиксированное число корзин, а не пользователей.
+    """
+
+    ACTIVE_WINDOWS = {'1h': 3600, '24h': 86400, '7d': 7 * 86400, '30d': 30 * 86400}
+    ACTIVE_LEVELS = ((60, 2 * 3600), (3600, 2 * 86400), (86400, 31 * 86400))  # (ширина, хранить секунд)
+
+    def __init__(self):
+        self._rows = {}
+        self._first_seen = array('q')
+        self._message_count = array('q')
+        self._last_active = array('q')
+        # Для каждой ширины: корзина последней активности -> пользователей
+        self._active = [{} for _ in self.ACTIVE_LEVELS]
+        self._pruned_at = 0
+        self.total_messages = 0
+        self.per_minute = RingCounter(60, 60)
+        self.per_hour = RingCounter(3600, 24)
+        self.model_usage = {}
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._rows
+
+    def get(self, user_id: int) -> UserStats:
+        row = self._rows.get(user_id)
+        if row is None:
+            return None
+        return UserStats(self._first_seen[row], self._message_count[row], self._last_active[row])
+
+    def _move_active(self, previous: int, current: int):
+        if previous is not None and previous // 60 == current // 60:
+            return  # Та же минута - значит, и тот же час и день
+        for buckets, (width, _) in zip(self._active, self.ACTIVE_LEVELS):
+            if previous is not None:
+                old = previous // width
+                if old in buckets:
+                    buckets[old] -= 1
+                    if not buckets[old]:
+                        del buckets[old]
+            key = current // width
+            buckets[key] = buckets.get(key, 0) + 1
+
+    def _prune(self, now: int):
+        # Раз в минуту выбрасываем корзины, которые не попадут ни в одно окно
+        if now // 60 == self._pruned_at:
+            return
+        self._pruned_at = now // 60
+        for buckets, (width, keep) in zip(self._active, self.ACTIVE_LEVELS):
+            horizon = (now - keep) // width
+            for key in [key for key in buckets if key < horizon]:
+                del buckets[key]
+
+    def _append(self, user_id: int, first_seen: int, message_count: int, last_active: int):
+        self._rows[user_id] = len(self._first_seen)
+        self._first_seen.append(first_seen)
+        self._message_count.append(message_count)
+        self._last_active.append(last_active)
+
+    def touch(self, user_id: int, now: int = None):
+        """Учитывает сообщение пользователя"""
+        now = int(time.time()) if now is None else now
+        row = self._rows.get(user_id)
+        if row is None:
+            self._append(user_id, now, 1, now)
+            previous = None
+        else:
+            self._message_count[row] += 1
+            previous = self._last_active[row]
+            self._last_active[row] = now
+        self._move_active(previous, now)
+        self.total_messages += 1
+        self.per_minute.add(now)
+        self.per_hour.add(now)
+        self._prune(now)
+
+    def restore(self, user_id: int, first_seen: int, message_count: int, last_active: int):
+        """Добавляет пользователя из сохранённого состояния (без учёта в потоке сообщений)"""
+        if user_id in self._rows:
+            return
+        self._append(user_id, int(first_seen), message_count, int(last_active))
+        self._move_active(None, int(last_active))
+        self.total_messages += message_count
+
+    def row(self, user_id: int) -> tuple:
+        """(first_seen, message_count, last_active) для записи в хранилище"""
+        row = self._rows[user_id]
+        return self._first_seen[row], self._message_count[row], self._last_active[row]
+
+    def record_model(self, model_key: str):
+        self.model_usage[model_key] = self.model_usage.get(model_key, 0) + 1
+
+    def active_users(self, seconds: int, now: int = None) -> int:
+        """Пользователи, писавшие за последние seconds секунд (с точностью до корзины)"""
+        now = int(time.time()) if now is None else now
+        for buckets, (width, keep) in zip(self._active, self.ACTIVE_LEVELS):
+            if seconds <= keep:
+                break
+        current = now // width
+        return sum(buckets.get(key, 0) for key in range(current - seconds // width + 1, current + 1))
+
+    def summary(self, now: int = None) -> dict:
+        now = int(time.time()) if now is None else now
+        per_minute = self.per_minute.series(now)
+        per_hour = self.per_hour.series(now)
+        return {
+            "users": len(self._rows),
+            "active_users": {name: self.active_users(seconds, now) for name, seconds in self.ACTIVE_WINDOWS.items()},
+            "messages_total": self.total_messages,
+            "messages_last_minute": per_minute[-1],
+            "messages_last_hour": sum(per_minute),
+            "messages_last_24h": sum(per_hour),
+            "messages_per_hour": per_hour,
+            "model_usage": dict(self.model_usage)
+        }
+
+user_models = {}
+user_stats = UserStatsStore()  # Статистика по пользователям
+conversation_history = ConversationMemory()  # История диалогов
+
+# ==================== МОДЕЛИ AI ====================
+# context_tokens - размер контекста модели, в него должна влезть история.
+# Необязательный ключ 'cache': False отключает кэш ответов для модели
+AVAILABLE_MODELS = {
+    'deepseek': {
+        'name': '🧠 DeepSeek Chat',
+        'id': 'deepseek/deepseek-chat',
+        'description': 'Умная и эффективная модель для общих задач',
+        'context_tokens': 64000
+    },
+    'deepseek-coder': {
+        'name': '💻 DeepSeek Coder',
+        'id': 'deepseek/deepseek-coder',
+        'description': 'Специализирована на программировании и коде',
+        'context_tokens': 16000
+    },
+    'gpt': {
+        'name': '🤖 GPT-3.5 Turbo',
+        'id': 'openai/gpt-3.5-turbo',
+        'description': 'Быстрая и умная модель от OpenAI',
+        'context_tokens': 16385
+    },
+    'claude': {
+        'name': '🎭 Claude Haiku',
+        'id': 'anthropic/claude-3-haiku',
+        'description': 'Быстрая и креативная модель от Anthropic',
+        'context_tokens': 200000
+    },
+    'gemini': {
+        'name': '💎 Gemini Pro',
+        'id': 'google/gemini-pro',
+        'description': 'Мощная модель от Google',
+        'context_tokens': 32768
+    }
+}
+
+# ==================== FLASK РОУТЫ ====================
+def home():
+    return "🤖 Multi-AI Bot is running! 🚀"
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def health_payload() -> dict:
+    return {"status": "OK", "timestamp": datetime.now().isoformat()}
+
+def readiness_payload() -> dict:
+    """Готовность принимать трафик: в отличие от /healthz, false до конца запуска"""
+    return {
+        "status": "READY" if startup.ready else "STARTING",
+        "startup": startup.as_dict(),
+        "timestamp": datetime.now().isoformat()
+    }
+
+def stats_payload() -> dict:
+    """Статистика бота"""
+    return {
+        "users_count": len(user_models),
+        "active_users": len(user_stats),
+        "activity": user_stats.summary(),
+        "upstream_requests": inflight_requests.leaders,
+        "coalesced_requests": inflight_requests.coalesced,
+        "model_fallbacks": model_router.fallbacks,
+        "rate_limit_reroutes": model_router.rate_limited,
+        "hedged_requests": model_router.hedged,
+        "circuit_breakers": {key: breaker.state for key, breaker in model_router.breakers.items()},
+        "timestamp": datetime.now().isoformat()
+    }
+
+def _merge_counts(total: dict, part: dict):
+    """Прибавляет числа из part к total: словари - по ключам, списки - поэлементно"""
+    for key, value in part.items():
+        if isinstance(value, dict):
+            _merge_counts(total.setdefault(key, {}), value)
+        elif isinstance(value, list):
+            current = total.get(key) or [0] * len(value)
+            total[key] = [a + b for a, b in zip(current, value)]
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            total[key] = total.get(key, 0) + value
+
+def merge_stats_payloads(payloads: dict) -> dict:
+    """Сводит stats_payload() воркеров: пользователи по воркерам не пересекаются,
+    поэтому счётчики просто складываются. Состояние breaker-ов - своё у каждого воркера."""
+    merged = {}
+    for payload in payloads.values():
+        _merge_counts(merged, {key: value for key, value in payload.items() if key != 'circuit_breakers'})
+    merged['circuit_breakers'] = {index: payload.get('circuit_breakers', {}) for index, payload in payloads.items()}
+    merged['timestamp'] = datetime.now().isoformat()
+    return merged
+
+def health_check():
+    return health_payload(), 200
+
+def readiness_check():
+    return readiness_payload(), 200 if startup.ready else 503
+
+def stats():
+    """Статистика бота"""
+    return stats_payload()
+
+def metrics_endpoint():
+    """Метрики в формате Prometheus"""
+    return metrics.render(), 200, {'Content-Type': METRICS_CONTENT_TYPE}
+
+def create_flask_app():
+    """Flask нужен только в режиме polling - импортируем его при запуске сервера"""
+    from flask import Flask
+    
+    app = Flask(__name__)
+    app.add_url_rule('/', view_func=home)
+    app.add_url_rule('/healthz', view_func=health_check)
+    app.add_url_rule('/readyz', view_func=readiness_check)
+    app.add_url_rule('/stats', view_func=stats)
+    app.add_url_rule('/metrics', view_func=metrics_endpoint)
+    return app
+
+def run_flask():
+    create_flask_app().run(host='0.0.0.0', port=HTTP_PORT, debug=False)
+
+# ==================== СИСТЕМА АКТИВНОСТИ ====================
+def keep_bot_awake():
+    """Периодически пингует сам себя чтобы не засыпать"""
+    def ping():
+        import requests
+        
+        time.sleep(30)  # Ждем запуска Flask
+        while True:
+            try:
+                requests.get(f"http://localhost:{HTTP_PORT}/healthz", timeout=10)
+                logger.info("✅ Keep-alive ping sent")
+            except Exception as e:
+                logger.warning(f"⚠️ Keep-alive ping failed: {e}")
+            time.sleep(300)  # Каждые 5 минут
+    
+    ping_thread = threading.Thread(target=ping)
+    ping_thread.daemon = True
+    ping_thread.start()
+
+# ==================== МЕТРИКИ ====================
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Metric:
+    """Базовая метрика с набором меток"""
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels[name] for name in self.labelnames)
+
+    def samples(self):
+        """Строки в текстовом формате Prometheus"""
+        for key, value in list(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (),
+                 buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # [счётчики по корзинам (последняя - +Inf), сумма, количество]
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def samples(self):
+        for key, (counts, total, count) in list(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), list(counts)):
+                cumulative += bucket_count
+                le = _format_labels(self.labelnames, key, f'le="{bound}"')
+                yield f"{self.name}_bucket{le} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {count}"
+
+class CallbackMetric(Metric):
+    """Метрика, значения которой считаются в момент чтения /metrics"""
+
+    def __init__(self, name: str, help_text: str, kind: str, labelnames: tuple, func):
+        super().__init__(name, help_text, labelnames)
+        self.kind = kind
+        self.func = func
+
+    def samples(self):
+        for key, value in self.func().items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+class MetricsRegistry:
+    """Набор метрик бота с выводом в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames: tuple = ()) -> Counter:
+        return self.register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str, labelnames: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames: tuple = (),
+                  buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def callback(self, name: str, help_text: str, kind: str, labelnames: tuple, func) -> CallbackMetric:
+        return self.register(CallbackMetric(name, help_text, kind, labelnames, func))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+def _with_label(sample: str, label: str) -> str:
+    """Добавляет метку в строку образца: name{a="1"} 2 -> name{label,a="1"} 2"""
+    end = min(index for index in (sample.find('{'), sample.find(' ')) if index != -1)
+    if sample[end] == '{':
+        return f"{sample[:end + 1]}{label},{sample[end + 1:]}"
+    return f"{sample[:end]}{{{label}}}{sample[end:]}"
+
+def merge_metrics(sources) -> str:
+    """Склеивает вывод render() нескольких процессов в одну выдачу.
+
+    sources - пары (номер воркера или None, текст). Образцы воркера получают
+    метку worker, образцы одной метрики идут подряд под одними HELP и TYPE.
+    """
+    families = {}
+    for worker, text in sources:
+        family = None
+        for line in text.splitlines():
+            if line.startswith('# '):
+                name = line.split(' ', 3)[2]
+                family = families.setdefault(name, {'HELP': None, 'TYPE': None, 'samples': []})
+                family[line[2:6]] = family[line[2:6]] or line
+            elif line and family is not None:
+                family['samples'].append(line if worker is None else _with_label(line, f'worker="{worker}"'))
+    lines = []
+    for family in families.values():
+        lines.extend(header for header in (family['HELP'], family['TYPE']) if header)
+        lines.extend(family['samples'])
+    return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+handler_requests = metrics.counter('bot_handler_requests_total', 'Вызовы обработчиков', ('handler', 'status'))
+handler_latency = metrics.histogram('bot_handler_latency_seconds', 'Время работы обработчиков', ('handler',))
+handler_in_flight = metrics.gauge('bot_handler_in_flight', 'Обработчики, выполняющиеся сейчас', ('handler',))
+upstream_latency = metrics.histogram('openrouter_request_latency_seconds', 'Полное время запроса к OpenRouter', ('model',))
+upstream_first_token = metrics.histogram('openrouter_first_token_seconds', 'Время до первого фрагмента потока', ('model',))
+upstream_responses = metrics.counter('openrouter_responses_total', 'Ответы OpenRouter по статусам', ('model', 'status'))
+upstream_tokens = metrics.counter('openrouter_tokens_total', 'Израсходованные токены', ('model', 'kind'))
+upstream_in_flight = metrics.gauge('openrouter_in_flight', 'Запросы к OpenRouter в работе', ('model',))
+voice_stage_latency = metrics.histogram('voice_input_stage_seconds', 'Время этапов обработки голосовых', ('stage',))
+tts_stage_latency = metrics.histogram('tts_stage_seconds', 'Время этапов синтеза речи', ('stage',))
+event_loop_lag = metrics.histogram('event_loop_lag_seconds', 'Задержка event loop', (),
+                                   (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+
+def track_handler(func):
+    """Считает вызовы, ошибки и время работы обработчика"""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(update, context):
+        handler_in_flight.inc(handler=name)
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            result = await func(update, context)
+            status = 'ok'
+            return result
+        finally:
+            handler_in_flight.dec(handler=name)
+            handler_latency.observe(time.perf_counter() - started, handler=name)
+            handler_requests.inc(handler=name, status=status)
+    return wrapper
+
+async def monitor_event_loop_lag(interval: float = 0.5):
+    """Измеряет, насколько позже запланированного просыпается event loop"""
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        event_loop_lag.observe(max(0.0, time.monotonic() - started - interval))
+
+def _record_usage(model_id: str, usage: dict):
+    if usage:
+        upstream_tokens.inc(usage.get('prompt_tokens', 0), model=model_id, kind='prompt')
+        upstream_tokens.inc(usage.get('completion_tokens', 0), model=model_id, kind='completion')
+
+def _upstream_status(error: Exception) -> str:
+    if isinstance(error, OpenRouterError):
+        return str(error.status)
+    if isinstance(error, asyncio.TimeoutError):
+        return 'timeout'
+    return 'error'
+
+# ==================== КЛИЕНТ OPENROUTER ====================
+class OpenRouterError(Exception):
+    """Ответ OpenRouter с кодом, отличным от 200"""
+
+    def __init__(self, status: int, body: str = ''):
+        super().__init__(f"OpenRouter вернул {status}: {body[:200]}")
+        self.status = status
+        self.body = body
+
+class OpenRouterClient:
+    """Асинхронный клиент OpenRouter с общим пулом keep-alive соединений"""
+
+    def __init__(self, api_key: str, url: str = OPENROUTER_URL,
+                 max_connections: int = OPENROUTER_MAX_CONNECTIONS,
+                 connect_timeout: float = OPENROUTER_CONNECT_TIMEOUT,
+                 read_timeout: float = OPENROUTER_READ_TIMEOUT,
+                 keepalive_timeout: float = OPENROUTER_KEEPALIVE):
+        self.api_key = api_key
+        self.url = url
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Создаёт сессию лениво - внутри работающего event loop"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=0,
+                limit_per_host=self.max_connections,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=300
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=None,
+                sock_connect=self.connect_timeout,
+                sock_read=self.read_timeout
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=timeout,
+                headers={
+                    'Authorization': f'Bearer {self.api_key}',
+                    'Content-Type': 'application/json'
+                }
+            )
+        return self._session
+
+    async def chat_completion(self, model_id: str, messages: list, max_tokens: int) -> dict:
+        """Запрашивает полный ответ модели"""
+        data = {
+            'model': model_id,
+            'messages': messages,
+            'max_tokens': max_tokens
+        }
+        upstream_in_flight.inc(model=model_id)
+        started = time.perf_counter()
+        status = 'cancelled'
+        try:
+            async with self._get_session().post(self.url, json=data) as response:
+                if response.status != 200:
+                    raise OpenRouterError(response.status, await response.text())
+                result = await response.json()
+            status = '200'
+            _record_usage(model_id, result.get('usage'))
+            return result
+        except Exception as e:
+            status = _upstream_status(e)
+            raise
+        finally:
+            upstream_in_flight.dec(model=model_id)
+            upstream_latency.observe(time.perf_counter() - started, model=model_id)
+            upstream_responses.inc(model=model_id, status=status)
+
+    async def stream_chat_completion(self, model_id: str, messages: list, max_tokens: int):
+        """Запрашивает ответ в режиме SSE и отдаёт текст по мере генерации"""
+        data = {
+            'model': model_id,
+            'messages': messages,
+            'max_tokens': max_tokens,
+            'stream': True,
+            'usage': {'include': True}
+        }
+        upstream_in_flight.inc(model=model_id)
+        started = time.perf_counter()
+        first_token = True
+        status = 'cancelled'
+        try:
+            async with self._get_session().post(self.url, json=data) as response:
+                if response.status != 200:
+                    raise OpenRouterError(response.status, await response.text())
+                async for raw_line in response.content:
+                    line = raw_line.decode('utf-8').strip()
+                    # Пустые строки и комментарии (": OPENROUTER PROCESSING") пропускаем
+                    if not line.startswith('data:'):
+                        continue
+                    payload = line[5:].strip()
+                    if payload == '[DONE]':
+                        break
+                    chunk = json.loads(payload)
+                    if 'error' in chunk:
+                        raise OpenRouterError(response.status, str(chunk['error']))
+                    _record_usage(model_id, chunk.get('usage'))
+                    choices = chunk.get('choices') or [{}]
+                    delta = choices[0].get('delta', {}).get('content')
+                    if delta:
+                        if first_token:
+                            first_token = False
+                            upstream_first_token.observe(time.perf_counter() - started, model=model_id)
+                        yield delta
+            status = '200'
+        except Exception as e:
+            status = _upstream_status(e)
+            raise
+        finally:
+            upstream_in_flight.dec(model=model_id)
+            upstream_latency.observe(time.perf_counter() - started, model=model_id)
+            upstream_responses.inc(model=model_id, status=status)
+
+    async def close(self):
+        """Закрывает пул соединений"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+openrouter_client = OpenRouterClient(OPENROUTER_API_KEY)
+
+# ==================== КЭШ ОТВЕТОВ ====================
+class ResponseCache:
+    """Кэш ответов моделей с TTL и LRU-вытеснением по объёму.
+
+    Кэшируются только одиночные вопросы без контекста диалога: ответ
+    на "привет" не зависит от пользователя, а ответ с историей - зависит.
+    """
+
+    def __init__(self, ttl: float = RESPONSE_CACHE_TTL,
+                 max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+                 enabled: bool = RESPONSE_CACHE_ENABLED):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires_at, text)
+
+    def key_for(self, model_key: str, messages: list, max_tokens: int):
+        """Ключ кэша или None, если запрос кэшировать нельзя"""
+        if not self.enabled or not AVAILABLE_MODELS[model_key].get('cache', True):
+            return None
+        if len(messages) != 1:
+            return None
+        normalized = [
+            (message['role'], ' '.join(message['content'].split()).casefold())
+            for message in messages
+        ]
+        return (AVAILABLE_MODELS[model_key]['id'], tuple(normalized), max_tokens)
+
+    def get(self, key):
+        if key is None:
+            return None
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, text = entry
+        if expires_at < time.monotonic():
+            self._drop(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return text
+
+    def put(self, key, text: str):
+        if key is None or not text:
+            return
+        cost = len(text.encode('utf-8'))
+        if cost > self.max_bytes:
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (time.monotonic() + self.ttl, text)
+        self.size += cost
+        while self.size > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        _, text = self._entries.pop(key)
+        self.size -= len(text.encode('utf-8'))
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+response_cache = ResponseCache()
+
+# ==================== ОБЪЕДИНЕНИЕ ЗАПРОСОВ ====================
+class SingleFlight:
+    """Склеивает одинаковые одновременные запросы в один.
+
+    Первый вызов запускает запрос отдельной задачей, остальные с тем же
+    ключом ждут её же результат или ошибку. Отмена одного из ожидающих
+    не прерывает общий запрос.
+    """
+
+    def __init__(self):
+        self.leaders = 0  # Реально выполненные запросы
+        self.coalesced = 0  # Вызовы, присоединившиеся к уже идущему
+        self._calls = {}
+
+    def in_flight(self, key) -> bool:
+        return key in self._calls
+
+    async def do(self, key, factory):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Забираем ошибку, даже если её уже некому ждать
+        if not task.cancelled():
+            task.exception()
+
+def completion_key(model_id: str, messages: list, max_tokens: int) -> tuple:
+    """Точный ключ запроса к модели для объединения одинаковых вызовов"""
+    return (model_id, tuple((m['role'], m['content']) for m in messages), max_tokens)
+
+inflight_requests = SingleFlight()
+
+# ==================== УСТОЙЧИВОСТЬ К СБОЯМ МОДЕЛЕЙ ====================
+class TokenBucket:
+    """Лимит запросов: rate токенов в секунду, не больше burst подряд"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> bool:
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def refund(self):
+        """Возвращает токен, взятый зря"""
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def wait_time(self) -> float:
+        """Сколько секунд ждать до следующего токена"""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst
+
+class CircuitBreaker:
+    """Предохранитель модели по доле ошибок и медленных ответов.
+
+    Если за окно набралось достаточно запросов и слишком многие из них
+    упали или были медленными, модель отключается на cooldown секунд,
+    после чего пропускается один пробный запрос.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, window: float = BREAKER_WINDOW, min_requests: int = BREAKER_MIN_REQUESTS,
+                 error_rate: float = BREAKER_ERROR_RATE, slow_call: float = BREAKER_SLOW_CALL,
+                 slow_rate: float = BREAKER_SLOW_RATE, cooldown: float = BREAKER_COOLDOWN):
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.latencies = deque(maxlen=200)  # Успешные ответы - для p95
+        self._calls = deque()  # (время, успех, медленный)
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+        if self.state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def release(self):
+        """Возвращает право на пробный запрос, если он так и не ушёл или был отменён"""
+        if self.state == self.HALF_OPEN:
+            self._probe_in_flight = False
+
+    def record(self, ok: bool, latency: float):
+        now = time.monotonic()
+        slow = latency > self.slow_call
+        if ok:
+            self.latencies.append(latency)
+        
+        if self.state == self.HALF_OPEN:
+            self._probe_in_flight = False
+            if ok and not slow:
+                self.state = self.CLOSED
+                self._calls.clear()
+            else:
+                self._open(now)
+            return
+        
+        self._calls.append((now, ok, slow))
+        while self._calls and now - self._calls[0][0] > self.window:
+            self._calls.popleft()
+        total = len(self._calls)
+        if self.state == self.CLOSED and total >= self.min_requests:
+            errors = sum(1 for _, call_ok, _ in self._calls if not call_ok)
+            slow_calls = sum(1 for _, _, call_slow in self._calls if call_slow)
+            if errors / total >= self.error_rate or slow_calls / total >= self.slow_rate:
+                self._open(now)
+
+    def _open(self, now: float):
+        self.state = self.OPEN
+        self._opened_at = now
+        self._calls.clear()
+
+    def p95(self):
+        """95-й перцентиль задержки или None, если данных мало"""
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """Ошибка на стороне модели, а не запроса: её учитывает предохранитель,
+    и запрос можно отдать другой модели. На 400/401/403 и подобные другая
+    модель ответит так же, а отключать модель из-за плохого запроса нельзя.
+    """
+    if isinstance(error, OpenRouterError):
+        return error.status >= 500 or error.status in (408, 429)
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError))
+
+class ModelRouter:
+    """Выбирает модель для запроса: лимиты, предохранители и запасные модели.
+
+    Запрос уходит к выбранной пользователем модели, а если она отключена
+    предохранителем, исчерпала лимит или упала - к следующей в цепочке.
+    """
+
+    def __init__(self, client: OpenRouterClient, chain: list, hedge: bool = HEDGE_ENABLED):
+        self.client = client
+        self.chain = [key for key in chain if key in AVAILABLE_MODELS]
+        self.hedge = hedge
+        self.fallbacks = 0
+        self.rate_limited = 0
+        self.hedged = 0
+        self.buckets = {key: TokenBucket(MODEL_RATE_LIMIT, MODEL_RATE_BURST) for key in AVAILABLE_MODELS}
+        self.breakers = {key: CircuitBreaker() for key in AVAILABLE_MODELS}
+
+    def candidates(self, model_key: str) -> list:
+        return [model_key] + [key for key in self.chain if key != model_key]
+
+    async def _admit(self, model_key: str, wait: float = 0) -> str:
+        """Пускает запрос к модели; возвращает None или причину отказа: 'open' или 'rate_limit'.
+
+        Пустой лимит ждём до wait секунд - короткий всплеск не должен менять модель.
+        """
+        breaker = self.breakers[model_key]
+        if not breaker.allow():
+            return 'open'
+        bucket = self.buckets[model_key]
+        deadline = time.monotonic() + wait
+        try:
+            while not bucket.try_acquire():
+                delay = bucket.wait_time()
+                if time.monotonic() + delay > deadline:
+                    # Запрос не уйдёт - пробный запрос достанется следующему
+                    breaker.release()
+                    return 'rate_limit'
+                await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            breaker.release()
+            raise
+        return None
+
+    def _note_fallback(self, model_key: str, key: str, reason: str):
+        if reason == 'rate_limit':
+            self.rate_limited += 1
+            logger.info(f"🚦 Модель {model_key} упёрлась в лимит запросов, отвечает {key}")
+        else:
+            self.fallbacks += 1
+            logger.warning(f"⚠️ Модель {model_key} недоступна, отвечает {key}")
+
+    async def _attempt(self, model_key: str, messages: list, max_tokens: int) -> tuple:
+        started = time.monotonic()
+        try:
+            result = await self.client.chat_completion(
+                AVAILABLE_MODELS[model_key]['id'], messages, max_tokens
+            )
+            text = result['choices'][0]['message']['content']
+        except asyncio.CancelledError:
+            self.breakers[model_key].release()
+            raise
+        except Exception as e:
+            if is_upstream_failure(e):
+                self.breakers[model_key].record(False, time.monotonic() - started)
+            else:
+                self.breakers[model_key].release()
+            raise
+        self.breakers[model_key].record(True, time.monotonic() - started)
+        return text, model_key
+
+    async def complete(self, model_key: str, messages: list, max_tokens: int) -> tuple:
+        """Возвращает (текст, ключ ответившей модели)"""
+        last_error = None
+        reason = None  # Почему не ответила выбранная модель
+        pending = deque(self.candidates(model_key))
+        while pending:
+            key = pending.popleft()
+            refused = await self._admit(key, MODEL_RATE_WAIT if key == model_key else 0)
+            if refused:
+                reason = reason or refused
+                continue
+            if key != model_key:
+                self._note_fallback(model_key, key, reason)
+            try:
+                return await self._complete_hedged(key, pending, messages, max_tokens)
+            except (OpenRouterError, aiohttp.ClientError, asyncio.TimeoutError, KeyError) as e:
+                if not is_upstream_failure(e):
+                    # Ошибка самого запроса - другая модель её не исправит
+                    raise
+                last_error = e
+                reason = reason or 'error'
+        raise last_error or OpenRouterError(503, 'Все модели временно недоступны')
+
+    async def _complete_hedged(self, key: str, pending: deque, messages: list, max_tokens: int) -> tuple:
+        """Если модель отвечает дольше своего p95, параллельно спрашивает следующую"""
+        primary = asyncio.ensure_future(self._attempt(key, messages, max_tokens))
+        threshold = self.breakers[key].p95() if self.hedge else None
+        if threshold is None:
+            return await primary
+        
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=threshold)
+        except asyncio.CancelledError:
+            primary.cancel()
+            raise
+        if done:
+            return primary.result()
+        
+        backup_key = None
+        for candidate in pending:
+            if not await self._admit(candidate):
+                backup_key = candidate
+                break
+        if backup_key is None:
+            return await primary
+        pending.remove(backup_key)
+        self.hedged += 1
+        backup = asyncio.ensure_future(self._attempt(backup_key, messages, max_tokens))
+        
+        tasks = {primary, backup}
+        try:
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None or not is_upstream_failure(task.exception()):
+                        return task.result()
+            # Обе попытки упали - отдаём ошибку основной модели
+            return primary.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Дожидаемся отмены, чтобы проигравшая попытка вернула пробный запрос предохранителю
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def open_stream(self, model_key: str, messages: list, max_tokens: int) -> tuple:
+        """Открывает потоковый ответ первой здоровой модели.
+
+        Модель считается выбранной после первого фрагмента текста, дальше
+        переключения нет. Возвращает (ключ модели, асинхронный итератор фрагментов).
+        """
+        last_error = None
+        reason = None
+        for key in self.candidates(model_key):
+            refused = await self._admit(key, MODEL_RATE_WAIT if key == model_key else 0)
+            if refused:
+                reason = reason or refused
+                continue
+            if key != model_key:
+                self._note_fallback(model_key, key, reason)
+            started = time.monotonic()
+            stream = self.client.stream_chat_completion(AVAILABLE_MODELS[key]['id'], messages, max_tokens)
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                first = ''
+            except asyncio.CancelledError:
+                self.breakers[key].release()
+                await stream.aclose()
+                raise
+            except (OpenRouterError, aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                if not is_upstream_failure(e):
+                    self.breakers[key].release()
+                    raise
+                self.breakers[key].record(False, time.monotonic() - started)
+                last_error = e
+                reason = reason or 'error'
+                continue
+            # Для потока задержка - время до первого фрагмента
+            self.breakers[key].record(True, time.monotonic() - started)
+            return key, self._chain_stream(first, stream)
+        raise last_error or OpenRouterError(503, 'Все модели временно недоступны')
+
+    @staticmethod
+    async def _chain_stream(first: str, stream):
+        if first:
+            yield first
+        async for delta in stream:
+            yield delta
+
+    def describe(self, model_key: str, answered_key: str) -> str:
+        """Подпись ответа: какая модель ответила на самом деле"""
+        name = AVAILABLE_MODELS[answered_key]['name']
+        if answered_key != model_key:
+            return f"{name} (вместо {AVAILABLE_MODELS[model_key]['name']})"
+        return name
+
+model_router = ModelRouter(openrouter_client, MODEL_FALLBACK_CHAIN.split(','))
+
+async def request_completion(model_key: str, messages: list, max_tokens: int,
+                             cache_checked: bool = False) -> tuple:
+    """Возвращает (текст ответа, ключ ответившей модели), по возможности из кэша.
+
+    cache_checked=True - вызывающий уже смотрел в кэш, повторный промах не считаем.
+    """
+    if not cache_checked:
+        cached = response_cache.get(response_cache.key_for(model_key, messages, max_tokens))
+        if cached is not None:
+            return cached, model_key
+    
+    model_id = AVAILABLE_MODELS[model_key]['id']
+    text, answered_key = await inflight_requests.do(
+        completion_key(model_id, messages, max_tokens),
+        lambda: model_router.complete(model_key, messages, max_tokens)
+    )
+    # Ответ запасной модели кэшируем под её собственным ключом
+    response_cache.put(response_cache.key_for(answered_key, messages, max_tokens), text)
+    return text, answered_key
+
+async def stream_completion(reply, model_key: str, messages: list, max_tokens: int) -> tuple:
+    """Показывает ответ по мере генерации, возвращает (текст, ключ ответившей модели)"""
+    await reply.start()
+    answered_key, deltas = await model_router.open_stream(model_key, messages, max_tokens)
+    if answered_key != model_key:
+        reply.retitle(f"🤖 {model_router.describe(model_key, answered_key)}:\n\n")
+    text = await reply.consume(deltas)
+    response_cache.put(response_cache.key_for(answered_key, messages, max_tokens), text)
+    return text, answered_key
+
+# ==================== ОТПРАВКА СООБЩЕНИЙ ====================
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list:
+    """Режет длинный текст на части по абзацам, строкам и предложениям.
+
+    Блок кода, попавший на границу, закрывается в одной части и заново
+    открывается в следующей, чтобы разметка не ломалась.
+    """
+    fence = '```'
+    parts = []
+    while len(text) > limit:
+        # Оставляем место под закрывающий и открывающий ```
+        window = text[:limit - len(fence) - 1]
+        cut = -1
+        for separator in ('\n' + fence, '\n\n', '\n', '. ', '! ', '? ', ' '):
+            position = window.rfind(separator, len(window) // 2)
+            if position > 0:
+                cut = position + (len(separator) if separator.strip() in '.!?' else 0)
+                break
+        if cut <= 0:
+            cut = len(window)
+        
+        head, text = text[:cut].rstrip(), text[cut:].lstrip('\n ')
+        if head.count(fence) % 2 == 1:
+            head += '\n' + fence
+            text = fence + '\n' + text
+        parts.append(head)
+    if text:
+        parts.append(text)
+    return parts
+
+def to_seconds(value) -> float:
+    """Длительность из Bot API в секундах: PTB отдаёт её числом или timedelta"""
+    return value.total_seconds() if hasattr(value, 'total_seconds') else value
+
+class SendScheduler:
+    """Очередь исходящих запросов к Bot API с учётом лимитов Telegram.
+
+    Сообщения каждого чата уходят строго по порядку и не чаще chat_rate в
+    секунду, все чаты вместе - не чаще global_rate. На RetryAfter чат
+    ставится на паузу, и запрос повторяется.
+    """
+
+    def __init__(self, global_rate: float = SEND_GLOBAL_RATE, chat_rate: float = SEND_CHAT_RATE,
+                 chat_burst: int = SEND_CHAT_BURST, max_retries: int = SEND_MAX_RETRIES):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.sent = 0
+        self.retried = 0
+        self._global = TokenBucket(global_rate, max(1, int(global_rate)))
+        self._chat_buckets = {}
+        self._queues = {}  # chat_id -> deque[(factory, future, attempts)]
+        self._ready = deque()  # Чаты, у которых есть что отправить и ничего не в пути
+        self._paused_until = {}
+        self._actions = {}  # (chat_id, action) -> до какого времени действие ещё видно
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    @property
+    def depth(self) -> int:
+        return sum(len(queue) for queue in list(self._queues.values()))
+
+    async def submit(self, chat_id: int, factory):
+        """Ставит вызов Bot API в очередь чата и ждёт его результата"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+            self._ready.append(chat_id)
+        queue.append((factory, future, 0))
+        self._wakeup.set()
+        return await future
+
+    async def send_text(self, message, text: str) -> list:
+        """Отвечает на сообщение, при необходимости разбивая текст на части"""
+        return [
+            await self.submit(message.chat_id, lambda part=part: message.reply_text(part))
+            for part in split_message(text)
+        ]
+
+    async def chat_action(self, bot, chat_id: int, action: str):
+        """Показывает действие, если такое же не отправлено только что"""
+        now = time.monotonic()
+        key = (chat_id, action)
+        if self._actions.get(key, 0) > now:
+            return
+        if len(self._actions) > 10000:
+            self._actions = {k: until for k, until in self._actions.items() if until > now}
+        self._actions[key] = now + CHAT_ACTION_TTL
+        try:
+            await bot.send_chat_action(chat_id=chat_id, action=action)
+        except RetryAfter:
+            pass  # Индикатор не важнее самих ответов
+        except TelegramError as e:
+            # Сбой индикатора не должен стоить пользователю ответа
+            logger.warning(f"⚠️ Не удалось показать {action} в чате {chat_id}: {e}")
+
+    async def _run(self):
+        while True:
+            delay = self._dispatch()
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch(self):
+        """Отправляет всё, что разрешают лимиты; возвращает, сколько спать до следующей попытки"""
+        now = time.monotonic()
+        delay = None
+        for _ in range(len(self._ready)):
+            chat_id = self._ready.popleft()
+            wait = self._paused_until.get(chat_id, 0) - now
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if wait <= 0 and not bucket.try_acquire():
+                wait = bucket.wait_time()
+            if wait > 0:
+                self._ready.append(chat_id)
+                delay = wait if delay is None else min(delay, wait)
+                continue
+            if not self._global.try_acquire():
+                bucket.refund()
+                self._ready.appendleft(chat_id)
+                wait = self._global.wait_time()
+                return wait if delay is None else min(delay, wait)
+            job = self._queues[chat_id].popleft()
+            asyncio.create_task(self._send(chat_id, job))
+        
+        if len(self._chat_buckets) > 10000:
+            self._chat_buckets = {
+                chat_id: bucket for chat_id, bucket in self._chat_buckets.items()
+                if chat_id in self._queues or not bucket.full
+            }
+        return delay
+
+    async def _send(self, chat_id: int, job: tuple):
+        factory, future, attempts = job
+        try:
+            if not future.done():
+                result = await factory()
+                self.sent += 1
+                if not future.done():
+                    future.set_result(result)
+        except RetryAfter as e:
+            retry_after = to_seconds(e.retry_after)
+            if attempts < self.max_retries:
+                self.retried += 1
+                logger.warning(f"⚠️ Telegram просит подождать {retry_after} c для чата {chat_id}")
+                self._paused_until[chat_id] = time.monotonic() + retry_after
+                self._queues[chat_id].appendleft((factory, future, attempts + 1))
+            elif not future.done():
+                future.set_exception(e)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            if self._queues[chat_id]:
+                self._ready.append(chat_id)
+            else:
+                del self._queues[chat_id]
+                self._paused_until.pop(chat_id, None)
+            self._wakeup.set()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+send_scheduler = SendScheduler()
+
+async def send_reply(update: Update, text: str) -> list:
+    """Отвечает в чат апдейта через очередь отправки"""
+    return await send_scheduler.send_text(update.effective_message, text)
+
+# ==================== ПОТОКОВЫЕ ОТВЕТЫ ====================
+class StreamingReply:
+    """Показывает ответ модели по мере генерации, редактируя сообщение в Telegram.
+
+    Правки объединяются по времени и объёму, чтобы не упираться в лимиты
+    Telegram на редактирование. Текст длиннее 4096 символов переносится
+    в новое сообщение.
+    """
+
+    PLACEHOLDER = '⏳'
+
+    def __init__(self, message, header: str = '',
+                 edit_interval: float = STREAM_EDIT_INTERVAL,
+                 min_chars: int = STREAM_EDIT_MIN_CHARS,
+                 limit: int = TELEGRAM_MESSAGE_LIMIT):
+        self.message = message
+        self.header = header
+        self.edit_interval = edit_interval
+        self.min_chars = min_chars
+        self.limit = limit
+        self.text = ''  # Весь ответ модели
+        self.finished = False
+        self._current = None  # Сообщение, которое сейчас редактируется
+        self._current_text = header  # Его полное содержимое
+        self._shown_text = ''  # Что уже видит пользователь
+        self._last_edit = 0.0
+        self._retry_at = 0.0
+
+    @property
+    def started(self) -> bool:
+        return self._current is not None
+
+    async def start(self):
+        """Сразу отправляет заглушку, чтобы пользователь видел реакцию"""
+        placeholder = f"{self.header}{self.PLACEHOLDER}"
+        self._current = await self._submit(lambda: self.message.reply_text(placeholder))
+        self._shown_text = f"{self.header}{self.PLACEHOLDER}"
+        self._last_edit = time.monotonic()
+
+    async def feed(self, delta: str):
+        """Добавляет очередной фрагмент ответа"""
+        self.text += delta
+        self._current_text += delta
+        
+        # Переносим излишек в новое сообщение
+        while len(self._current_text) > self.limit:
+            head, tail = self._current_text[:self.limit], self._current_text[self.limit:]
+            self._current_text = head
+            await self._edit(force=True)
+            self._current = await self._submit(lambda: self.message.reply_text(tail[:self.limit]))
+            self._current_text = tail
+            self._shown_text = tail[:self.limit]
+            self._last_edit = time.monotonic()
+        
+        await self._edit()
+
+    def retitle(self, header: str):
+        """Меняет заголовок, пока ответ ещё не начался"""
+        if not self.text:
+            self._current_text = header
+            self.header = header
+
+    async def consume(self, deltas) -> str:
+        """Показывает весь поток фрагментов и возвращает итоговый текст"""
+        if not self.started:
+            await self.start()
+        async for delta in deltas:
+            await self.feed(delta)
+        await self.finish()
+        return self.text
+
+    async def finish(self):
+        """Показывает окончательный текст"""
+        if not self.text:
+            self._current_text += '...'
+        await self._edit(force=True)
+        self.finished = True
+
+    async def abort(self, error_text: str):
+        """Дописывает сообщение об ошибке к уже показанному ответу"""
+        if len(self._current_text) + len(error_text) + 2 > self.limit:
+            await self._submit(lambda: self.message.reply_text(error_text))
+        else:
+            self._current_text = f"{self._current_text.rstrip()}\n\n{error_text}"
+            await self._edit(force=True)
+        self.finished = True
+
+    def _submit(self, factory):
+        return send_scheduler.submit(self.message.chat_id, factory)
+
+    async def _edit(self, force: bool = False):
+        if self._current_text == self._shown_text:
+            return
+        now = time.monotonic()
+        if not force:
+            if now < self._retry_at or now - self._last_edit < self.edit_interval:
+                return
+            if len(self._current_text) - len(self._shown_text) < self.min_chars:
+                return
+        elif now < self._retry_at:
+            await asyncio.sleep(self._retry_at - now)
+        
+        try:
+            text = self._current_text
+            current = self._current
+            await self._submit(lambda: current.edit_text(text))
+            self._shown_text = self._current_text
+        except RetryAfter as e:
+            retry_after = to_seconds(e.retry_after)
+            self._retry_at = time.monotonic() + retry_after
+            logger.warning(f"⚠️ Telegram ограничил правки на {retry_after} c")
+            if force:
+                await self._edit(force=True)
+        except BadRequest as e:
+            # "Message is not modified" и подобные - не критично
+            logger.debug(f"Правка сообщения пропущена: {e}")
+        self._last_edit = time.monotonic()
+
+# ==================== СИНТЕЗ РЕЧИ ====================
+class AudioCache:
+    """Кэш готовых OGG по (тексту, языку) с LRU-вытеснением по размеру.
+
+    Горячие записи живут в памяти, при заданном каталоге - дублируются на диск
+    и переживают перезапуск. Диск ограничен disk_max_bytes: при превышении
+    удаляются файлы, которые дольше всех не читали (по mtime).
+    """
+
+    def __init__(self, max_bytes: int = TTS_CACHE_MAX_BYTES, cache_dir: str = None,
+                 disk_max_bytes: int = TTS_CACHE_DISK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_size = None  # Оценка занятого места; None - каталог ещё не сканировали
+        self._pruning = False
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(text: str, lang: str, codec: str = '') -> str:
+        normalized = ' '.join(text.split())
+        return hashlib.sha256(f"{lang}\0{codec}\0{normalized}".encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.ogg")
+
+    def _remember(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        if key in self._entries:
+            self.size -= len(self._entries.pop(key))
+        self._entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    async def get(self, key: str):
+        data = self._entries.get(key)
+        if data is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+        if self.cache_dir:
+            data = await asyncio.get_running_loop().run_in_executor(
+                _tts_fetch_pool, _read_file, self._path(key), True
+            )
+            if data is not None:
+                self._remember(key, data)
+                self.hits += 1
+                return data
+        self.misses += 1
+        return None
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    async def put(self, key: str, data: bytes):
+        self._remember(key, data)
+        if not self.cache_dir:
+            return
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(_tts_fetch_pool, _write_file, self._path(key), data)
+        if self.disk_size is not None:
+            self.disk_size += len(data)
+            if self.disk_size <= self.disk_max_bytes:
+                return
+        if self._pruning:
+            return
+        # Каталог могут делить несколько воркеров - реальный размер узнаём сканированием.
+        # Чистим с запасом, чтобы не сканировать каталог на каждой записи
+        self._pruning = True
+        try:
+            self.disk_size = await loop.run_in_executor(
+                _tts_fetch_pool, _prune_dir, self.cache_dir, self.disk_max_bytes, int(self.disk_max_bytes * 0.9)
+            )
+        finally:
+            self._pruning = False
+
+def _read_file(path: str, touch: bool = False):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    if touch:
+        # mtime - время последнего чтения, по нему _prune_dir выбирает, что удалить
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+    return data
+
+def _write_file(path: str, data: bytes):
+    # Пишем в уникальный временный файл, чтобы параллельные записи одного ключа
+    # не мешали друг другу, а читатель не увидел половину записи
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def _prune_dir(cache_dir: str, max_bytes: int, target_bytes: int) -> int:
+    """Удаляет самые старые .ogg, если каталог больше max_bytes; возвращает итоговый размер"""
+    entries = []
+    total = 0
+    now = time.time()
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.endswith('.tmp'):
+                # Остаток записи, прерванной падением процесса
+                if now - stat.st_mtime > 3600:
+                    _unlink_quietly(entry.path)
+                continue
+            if entry.name.endswith('.ogg'):
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+    if total <= max_bytes:
+        return total
+    entries.sort()
+    removed = 0
+    for _, size, path in entries:
+        if total <= target_bytes:
+            break
+        if _unlink_quietly(path):
+            total -= size
+            removed += 1
+    logger.info(f"🧹 Дисковый кэш TTS: удалено {removed} файлов, занято {total // 1024} КБ")
+    return total
+
+def _unlink_quietly(path: str) -> bool:
+    try:
+        os.unlink(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def _fetch_mp3(text: str, lang: str) -> bytes:
+    """Скачивает MP3 из gTTS (сетевой вызов, выполняется в потоке)"""
+    from gtts import gTTS
+    
+    tts = gTTS(text=text, lang=lang, slow=False)
+    mp3_fp = io.BytesIO()
+    tts.write_to_fp(mp3_fp)
+    return mp3_fp.getvalue()
+
+def _transcode_to_ogg(mp3_data: bytes) -> bytes:
+    """Перекодирует MP3 в OGG через pydub (TTS_TRANSCODER=pydub, выполняется в процессе)"""
+    from pydub import AudioSegment
+    
+    audio = AudioSegment.from_mp3(io.BytesIO(mp3_data))
+    ogg_fp = io.BytesIO()
+    audio.export(ogg_fp, format="ogg")
+    return ogg_fp.getvalue()
+
+def _get_transcode_pool() -> ProcessPoolExecutor:
+    global _tts_transcode_pool
+    if _tts_transcode_pool is None:
+        _tts_transcode_pool = ProcessPoolExecutor(max_workers=TTS_TRANSCODE_WORKERS)
+    return _tts_transcode_pool
+
+MP3_CHUNK_BYTES = 64 * 1024
+
+class OpusEncoderPool:
+    """Заранее запущенные процессы ffmpeg для перекодирования MP3 в OGG/Opus.
+
+    Запуск ffmpeg (fork/exec, загрузка библиотек кодеков) делается заранее и в
+    фоне, а не на пути ответа. Каждый процесс кодирует один файл: MP3 подаётся
+    в stdin, OGG/Opus читается из stdout одновременно, PCM целиком нигде не
+    собирается. Взятый из пула процесс сразу замещается новым.
+    """
+
+    def __init__(self, size: int = TTS_TRANSCODE_WORKERS, binary: str = FFMPEG_BINARY,
+                 bitrate: str = TTS_OPUS_BITRATE):
+        self.size = size
+        self.binary = binary
+        self.bitrate = bitrate
+        self.cold_starts = 0  # Пул был пуст - процесс запускали на пути ответа
+        self._idle = deque()
+        self._spawning = set()
+
+    @property
+    def idle(self) -> int:
+        return len(self._idle)
+
+    def command(self) -> list:
+        # Голосовые Telegram: Opus в контейнере OGG, моно 48 кГц
+        return [
+            self.binary, '-hide_banner', '-loglevel', 'error',
+            '-f', 'mp3', '-i', 'pipe:0',
+            '-vn', '-map_metadata', '-1',
+            '-c:a', 'libopus', '-b:a', self.bitrate, '-application', 'voip',
+            '-ac', '1', '-ar', '48000',
+            '-f', 'ogg', 'pipe:1'
+        ]
+
+    async def _spawn(self) -> asyncio.subprocess.Process:
+        return await asyncio.create_subprocess_exec(
+            *self.command(),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+
+    async def _spawn_idle(self):
+        try:
+            self._idle.append(await self._spawn())
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось запустить {self.binary}: {e}")
+
+    def replenish(self):
+        """Досоздаёт процессы в фоне до size штук"""
+        for _ in range(self.size - len(self._idle) - len(self._spawning)):
+            task = asyncio.create_task(self._spawn_idle())
+            self._spawning.add(task)
+            task.add_done_callback(self._spawning.discard)
+
+    async def fill(self):
+        """Заполняет пул и ждёт, пока процессы запустятся"""
+        self.replenish()
+        if self._spawning:
+            await asyncio.wait(set(self._spawning))
+
+    async def _acquire(self) -> asyncio.subprocess.Process:
+        process = None
+        while self._idle:
+            candidate = self._idle.popleft()
+            if candidate.returncode is None:
+                process = candidate
+                break
+        if process is None:
+            self.cold_starts += 1
+            process = await self._spawn()
+        self.replenish()
+        return process
+
+    async def transcode(self, mp3_data: bytes, timeout: float = TTS_TRANSCODE_TIMEOUT) -> bytes:
+        """MP3 -> OGG/Opus в уже запущенном ffmpeg"""
+        process = await self._acquire()
+        
+        async def feed():
+            try:
+                # Пишем порциями: ffmpeg начинает кодировать, не дожидаясь конца файла
+                for offset in range(0, len(mp3_data), MP3_CHUNK_BYTES):
+                    process.stdin.write(mp3_data[offset:offset + MP3_CHUNK_BYTES])
+                    await process.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # ffmpeg завершился раньше - причину покажет код возврата
+            finally:
+                process.stdin.close()
+        
+        try:
+            _, ogg_data, errors = await asyncio.wait_for(
+                asyncio.gather(feed(), process.stdout.read(), process.stderr.read()),
+                timeout=timeout
+            )
+            await process.wait()
+            if process.returncode != 0:
+                raise RuntimeError(f"{self.binary} завершился с кодом {process.returncode}: "
+                                   f"{errors.decode('utf-8', 'replace').strip()[-200:]}")
+            return ogg_data
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+
+    async def close(self):
+        for task in list(self._spawning):
+            task.cancel()
+        while self._idle:
+            process = self._idle.popleft()
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+
+_tts_fetch_pool = ThreadPoolExecutor(max_workers=TTS_FETCH_WORKERS, thread_name_prefix='tts-fetch')
+_tts_transcode_pool = None  # Процессы поднимаются при первом синтезе
+_tts_slots = asyncio.Semaphore(TTS_FETCH_WORKERS)
+_tts_pending = 0
+audio_cache = AudioCache(TTS_CACHE_MAX_BYTES, TTS_CACHE_DIR, TTS_CACHE_DISK_MAX_BYTES)
+opus_encoder = OpusEncoderPool()
+
+def shutdown_tts_pools():
+    """Останавливает пулы синтеза речи"""
+    _tts_fetch_pool.shutdown(wait=False, cancel_futures=True)
+    if _tts_transcode_pool is not None:
+        _tts_transcode_pool.shutdown(wait=False, cancel_futures=True)
+
+# ==================== РАСПОЗНАВАНИЕ РЕЧИ ====================
+STT_SAMPLE_RATE = 16000
+PCM_CHUNK_BYTES = STT_SAMPLE_RATE * 2  # Секунда 16-битного моно за одно чтение
+
+class VoiceTooLongError(Exception):
+    """Голосовое оказалось длиннее допустимого уже после декодирования"""
+
+class SpeechToTextUnavailable(RuntimeError):
+    """Распознаватель речи не настроен: нет vosk или модели по VOSK_MODEL_PATH"""
+
+class SpeechToText:
+    """Интерфейс распознавания: PCM 16 кГц моно s16le на входе, текст на выходе.
+
+    create_session() возвращает объект с методами feed(pcm: bytes) и
+    result() -> str. Оба блокирующие и вызываются из пула потоков.
+    """
+
+    name = 'base'
+
+    def create_session(self):
+        raise NotImplementedError
+
+class StubSpeechToText(SpeechToText):
+    """Заглушка для тестов и нагрузочных прогонов: всегда один и тот же текст"""
+
+    name = 'stub'
+
+    def __init__(self, text: str = 'привет'):
+        self.text = text
+
+    def create_session(self):
+        return _StubSession(self.text)
+
+class _StubSession:
+    def __init__(self, text: str):
+        self.text = text
+        self.received = 0
+
+    def feed(self, pcm: bytes):
+        self.received += len(pcm)
+
+    def result(self) -> str:
+        return self.text if self.received else ''
+
+class VoskSpeechToText(SpeechToText):
+    """Офлайн-распознавание через Vosk (pip install vosk + модель языка)"""
+
+    name = 'vosk'
+
+    def __init__(self, model_path: str):
+        import vosk  # Необязательная зависимость
+        vosk.SetLogLevel(-1)
+        self._vosk = vosk
+        self._model = vosk.Model(model_path)
+
+    def create_session(self):
+        return _VoskSession(self._vosk.KaldiRecognizer(self._model, STT_SAMPLE_RATE))
+
+class _VoskSession:
+    def __init__(self, recognizer):
+        self.recognizer = recognizer
+        self.parts = []
+
+    def feed(self, pcm: bytes):
+        if self.recognizer.AcceptWaveform(pcm):
+            self.parts.append(json.loads(self.recognizer.Result()).get('text', ''))
+
+    def result(self) -> str:
+        self.parts.append(json.loads(self.recognizer.FinalResult()).get('text', ''))
+        return ' '.join(part for part in self.parts if part).strip()
+
+def create_stt_backend(kind: str = STT_BACKEND):
+    """Создаёт распознаватель по имени из настроек; None - если он недоступен"""
+    if kind == 'stub':
+        return StubSpeechToText()
+    if kind == 'vosk':
+        try:
+            return VoskSpeechToText(VOSK_MODEL_PATH)
+        except Exception as e:
+            logger.warning(f"⚠️ Распознавание речи недоступно: {e}")
+            return None
+    raise ValueError(f"Неизвестный распознаватель речи: {kind}")
+
+_stt_pool = ThreadPoolExecutor(max_workers=VOICE_MAX_CONCURRENT, thread_name_prefix='stt')
+_voice_slots = asyncio.Semaphore(VOICE_MAX_CONCURRENT)
+_download_session = None
+stt_backend = None  # Создаётся при первом голосовом или прогреве - модель Vosk грузится долго
+_stt_backend_checked = False  # Неудачную загрузку не повторяем на каждом голосовом
+_stt_backend_lock = asyncio.Lock()
+
+async def get_stt_backend() -> SpeechToText:
+    """Распознаватель речи; создаётся один раз в пуле STT"""
+    global stt_backend, _stt_backend_checked
+    async with _stt_backend_lock:
+        if not _stt_backend_checked:
+            stt_backend = await asyncio.get_running_loop().run_in_executor(
+                _stt_pool, create_stt_backend, STT_BACKEND
+            )
+            _stt_backend_checked = True
+    if stt_backend is None:
+        raise SpeechToTextUnavailable("распознаватель речи не настроен")
+    return stt_backend
+
+def get_download_session() -> aiohttp.ClientSession:
+    """Отдельная сессия для файлов Telegram - без заголовков OpenRouter"""
+    global _download_session
+    if _download_session is None or _download_session.closed:
+        _download_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30)
+        )
+    return _download_session
+
+async def transcribe_voice(file_url: str, max_duration: float = VOICE_MAX_DURATION) -> str:
+    """Скачивает OGG/Opus потоком, декодирует ffmpeg в PCM и распознаёт по кусочкам.
+
+    Ни исходный файл, ни PCM целиком в памяти не держатся: скачивание,
+    декодирование и распознавание идут одновременно.
+    """
+    loop = asyncio.get_running_loop()
+    session = (await get_stt_backend()).create_session()
+    
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error',
+        '-i', 'pipe:0',
+        '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1', '-ar', str(STT_SAMPLE_RATE),
+        'pipe:1',
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    started = time.perf_counter()
+    
+    async def pump_download():
+        try:
+            async with get_download_session().get(file_url) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    process.stdin.write(chunk)
+                    await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # ffmpeg завершился раньше - об ошибке скажет код возврата
+        finally:
+            voice_stage_latency.observe(time.perf_counter() - started, stage='download')
+            if not process.stdin.is_closing():
+                process.stdin.close()
+    
+    downloader = asyncio.create_task(pump_download())
+    max_pcm_bytes = int(max_duration * STT_SAMPLE_RATE * 2)
+    pcm_bytes = 0
+    stt_seconds = 0.0
+    try:
+        while True:
+            chunk = await process.stdout.read(PCM_CHUNK_BYTES)
+            if not chunk:
+                break
+            pcm_bytes += len(chunk)
+            if pcm_bytes > max_pcm_bytes:
+                raise VoiceTooLongError()
+            stt_started = time.perf_counter()
+            await loop.run_in_executor(_stt_pool, session.feed, chunk)
+            stt_seconds += time.perf_counter() - stt_started
+        
+        await downloader
+        if await process.wait() != 0:
+            raise RuntimeError(f"ffmpeg завершился с кодом {process.returncode}")
+        voice_stage_latency.observe(time.perf_counter() - started, stage='transcode')
+        
+        stt_started = time.perf_counter()
+        text = await loop.run_in_executor(_stt_pool, session.result)
+        stt_seconds += time.perf_counter() - stt_started
+        voice_stage_latency.observe(stt_seconds, stage='transcribe')
+        return text
+    finally:
+        if not downloader.done():
+            downloader.cancel()
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+async def close_voice_pipeline():
+    """Закрывает сессию скачивания и пул распознавания"""
+    if _download_session is not None and not _download_session.closed:
+        await _download_session.close()
+    _stt_pool.shutdown(wait=False, cancel_futures=True)
+
+# ==================== ХРАНИЛИЩЕ СОСТОЯНИЯ ====================
+class MemoryStateBackend:
+    """Состояние только в памяти процесса - теряется при перезапуске"""
+
+    def load(self, shard: tuple = None, history_since: float = 0) -> tuple:
+        """Возвращает (user_models, user_stats, history_rows).
+
+        shard=(номер, всего) ограничивает выборку пользователями одного воркера,
+        history_since (time.time()) отсекает реплики, которые старше.
+        """
+        return {}, {}, []
+
+    def write_batch(self, models: dict, stats: dict, turns: list):
+        pass
+
+    def close(self):
+        pass
+
+class SQLiteStateBackend(MemoryStateBackend):
+    """Состояние в SQLite (WAL): выбор модели, статистика и история диалогов.
+
+    Все методы блокирующие и вызываются из одного выделенного потока.
+    """
+
+    def __init__(self, path: str = STATE_DB_PATH, history_turns: int = HISTORY_MAX_TURNS):
+        self.path = path
+        self.history_turns = history_turns
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            # Воркеры пишут в один файл - ждём блокировку, а не падаем сразу
+            self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS user_models (
+                    user_id INTEGER PRIMARY KEY,
+                    model_key TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS user_stats (
+                    user_id INTEGER PRIMARY KEY,
+                    first_seen REAL NOT NULL,
+                    message_count INTEGER NOT NULL,
+                    last_active REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS history (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    question TEXT NOT NULL,
+                    answer TEXT NOT NULL,
+                    timestamp REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS history_user ON history (user_id, id);
+            """)
+        return self._db
+
+    def load(self, shard: tuple = None, history_since: float = 0) -> tuple:
+        db = self._connect()
+        where, params = '', ()
+        if shard is not None:
+            index, count = shard
+            where, params = ' WHERE user_id % ? = ?', (count, index)
+        models = dict(db.execute('SELECT user_id, model_key FROM user_models' + where, params))
+        stats = {
+            user_id: (first_seen, message_count, last_active)
+            for user_id, first_seen, message_count, last_active
+            in db.execute('SELECT user_id, first_seen, message_count, last_active FROM user_stats' + where, params)
+        }
+        history = db.execute(
+            'SELECT user_id, question, answer, timestamp FROM history'
+            + (where + ' AND' if where else ' WHERE') + ' timestamp > ? ORDER BY id',
+            params + (history_since,)
+        ).fetchall()
+        return models, stats, history
+
+    def write_batch(self, models: dict, stats: dict, turns: list):
+        db = self._connect()
+        with db:
+            db.executemany(
+                'INSERT OR REPLACE INTO user_models (user_id, model_key) VALUES (?, ?)',
+                models.items()
+            )
+            db.executemany(
+                'INSERT OR REPLACE INTO user_stats (user_id, first_seen, message_count, last_active) '
+                'VALUES (?, ?, ?, ?)',
+                [(user_id, *row) for user_id, row in stats.items()]
+            )
+            db.executemany(
+                'INSERT INTO history (user_id, question, answer, timestamp) VALUES (?, ?, ?, ?)',
+                turns
+            )
+            # Храним не больше реплик, чем помнит ConversationMemory
+            db.executemany(
+                'DELETE FROM history WHERE user_id = ? AND id NOT IN '
+                '(SELECT id FROM history WHERE user_id = ? ORDER BY id DESC LIMIT ?)',
+                [(user_id, user_id, self.history_turns) for user_id in {turn[0] for turn in turns}]
+            )
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+class StateWriter:
+    """Отложенная пакетная запись состояния.
+
+    Обработчики только помечают изменённых пользователей, а фоновая задача
+    раз в interval секунд (или по накоплении batch_size изменений) пишет
+    всё одним пакетом. Чтение всегда идёт из словарей в памяти.
+    """
+
+    def __init__(self, backend, interval: float = STATE_FLUSH_INTERVAL,
+                 batch_size: int = STATE_FLUSH_BATCH):
+        self.backend = backend
+        self.interval = interval
+        self.batch_size = batch_size
+        self._models = set()
+        self._stats = set()
+        self._turns = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._models) + len(self._stats) + len(self._turns)
+
+    def mark_model(self, user_id: int):
+        self._models.add(user_id)
+        self._kick()
+
+    def mark_stats(self, user_id: int):
+        self._stats.add(user_id)
+        self._kick()
 
-# ==================== КОНФИГУРАЦИЯ ====================
-app = Flask(__name__)
+    def add_turn(self, user_id: int, question: str, answer: str):
+        self._turns.append((user_id, question, answer, time.time()))
+        self._kick()
 
-# Настройка продвинутого логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('bot.log', encoding='utf-8')
-    ]
-)
-logger = logging.getLogger(__name__)
+    def _kick(self):
+        if self.pending >= self.batch_size:
+            self._wakeup.set()
 
-# Получаем токены
-TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
-OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY')
+    async def load(self, shard: tuple = None):
+        """Прогревает словари в памяти сохранённым состоянием (только своего шарда)"""
+        # Реплики тех, кто молчит дольше idle_ttl, ConversationMemory уже забыла бы
+        wall_now = time.time()
+        models, stats, history = await asyncio.get_running_loop().run_in_executor(
+            _state_io_pool, self.backend.load, shard, wall_now - conversation_history.idle_ttl
+        )
+        user_models.update(models)
+        for user_id, row in stats.items():
+            user_stats.restore(user_id, *row)
+        # В базе - время по часам, в памяти - по monotonic: переносим возраст реплики
+        now = time.monotonic()
+        for user_id, question, answer, timestamp in history:
+            conversation_history.append(user_id, question, answer, now - (wall_now - timestamp))
+        logger.info(f"✅ Состояние загружено: {len(models)} моделей, {len(stats)} пользователей")
 
-# ==================== СИСТЕМА ПАМЯТИ ====================
-user_models = {}
-user_stats = {}  # Статистика по пользователям
-conversation_history = {}  # История диалогов
+    def start(self):
+        self._task = asyncio.create_task(self._run())
 
-# ==================== МОДЕЛИ AI ====================
-AVAILABLE_MODELS = {
-    'deepseek': {
-        'name': '🧠 DeepSeek Chat',
-        'id': 'deepseek/deepseek-chat',
-        'description': 'Умная и эффективная модель для общих задач'
-    },
-    'deepseek-coder': {
-        'name': '💻 DeepSeek Coder',
-        'id': 'deepseek/deepseek-coder', 
-        'description': 'Специализирована на программировании и коде'
-    },
-    'gpt': {
-        'name': '🤖 GPT-3.5 Turbo',
-        'id': 'openai/gpt-3.5-turbo',
-        'description': 'Быстрая и умная модель от OpenAI'
-    },
-    'claude': {
-        'name': '🎭 Claude Haiku',
-        'id': 'anthropic/claude-3-haiku',
-        'description': 'Быстрая и креативная модель от Anthropic'
-    },
-    'gemini': {
-        'name': '💎 Gemini Pro',
-        'id': 'google/gemini-pro',
-        'description': 'Мощная модель от Google'
-    }
-}
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
 
-# ==================== FLASK РОУТЫ ====================
-@app.route('/')
-def home():
-    return "🤖 Multi-AI Bot is running! 🚀"
+    async def flush(self):
+        """Записывает накопленные изменения одним пакетом"""
+        if not self.pending:
+            return
+        models = {user_id: user_models[user_id] for user_id in self._models if user_id in user_models}
+        stats = {user_id: user_stats.row(user_id) for user_id in self._stats if user_id in user_stats}
+        turns = self._turns
+        self._models, self._stats, self._turns = set(), set(), []
+        
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                _state_io_pool, self.backend.write_batch, models, stats, turns
+            )
+        except Exception as e:
+            # Вернём изменения в очередь - запишем в следующий раз
+            logger.error(f"❌ Ошибка записи состояния: {e}")
+            self._models.update(models)
+            self._stats.update(stats)
+            self._turns[:0] = turns
 
-@app.route('/healthz')
-def health_check():
-    return {"status": "OK", "timestamp": datetime.now().isoformat()}, 200
+    async def close(self):
+        """Останавливает фоновую запись, дописывает остаток и закрывает хранилище"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        await asyncio.get_running_loop().run_in_executor(_state_io_pool, self.backend.close)
 
-@app.route('/stats')
-def stats():
-    """Статистика бота"""
+def create_state_backend(kind: str = STATE_BACKEND):
+    """Создаёт хранилище состояния по имени из настроек"""
+    if kind == 'sqlite':
+        return SQLiteStateBackend(STATE_DB_PATH)
+    if kind == 'memory':
+        return MemoryStateBackend()
+    raise ValueError(f"Неизвестное хранилище состояния: {kind}")
+
+_state_io_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='state-io')
+state_writer = StateWriter(create_state_backend())
+
+def remember_turn(user_id: int, question: str, answer: str):
+    """Сохраняет реплику в памяти и ставит её в очередь на запись"""
+    conversation_history.append(user_id, question, answer)
+    state_writer.add_turn(user_id, question, answer)
+
+def _log_queue_handler() -> NonBlockingQueueHandler:
+    return next(h for h in logging.getLogger().handlers if isinstance(h, NonBlockingQueueHandler))
+
+def _log_sampler() -> SamplingFilter:
+    return next(f for f in _log_queue_handler().filters if isinstance(f, SamplingFilter))
+
+def _cache_stats(attribute: str) -> dict:
     return {
-        "users_count": len(user_models),
-        "active_users": len(user_stats),
-        "timestamp": datetime.now().isoformat()
+        ('response',): getattr(response_cache, attribute),
+        ('audio',): getattr(audio_cache, attribute)
     }
 
-def run_flask():
-    app.run(host='0.0.0.0', port=5000, debug=False)
-
-# ==================== СИСТЕМА АКТИВНОСТИ ====================
-def keep_bot_awake():
-    """Периодически пингует сам себя чтобы не засыпать"""
-    def ping():
-        time.sleep(30)  # Ждем запуска Flask
-        while True:
-            try:
-                requests.get("http://localhost:5000/healthz", timeout=10)
-                logger.info("✅ Keep-alive ping sent")
-            except Exception as e:
-                logger.warning(f"⚠️ Keep-alive ping failed: {e}")
-            time.sleep(300)  # Каждые 5 минут
-    
-    ping_thread = threading.Thread(target=ping)
-    ping_thread.daemon = True
-    ping_thread.start()
+metrics.callback('cache_hits_total', 'Попадания в кэш', 'counter', ('cache',), lambda: _cache_stats('hits'))
+metrics.callback('cache_misses_total', 'Промахи кэша', 'counter', ('cache',), lambda: _cache_stats('misses'))
+metrics.callback('cache_hit_ratio', 'Доля попаданий в кэш', 'gauge', ('cache',),
+                 lambda: _cache_stats('hit_ratio'))
+metrics.callback('openrouter_coalesced_total', 'Запросы, склеенные с уже идущими', 'counter', (),
+                 lambda: {(): inflight_requests.coalesced})
+metrics.callback('openrouter_fallbacks_total', 'Ответы запасных моделей', 'counter', (),
+                 lambda: {(): model_router.fallbacks})
+metrics.callback('openrouter_rate_limit_reroutes_total', 'Запросы, ушедшие другой модели из-за лимита', 'counter', (),
+                 lambda: {(): model_router.rate_limited})
+metrics.callback('circuit_breaker_open', 'Модель отключена предохранителем', 'gauge', ('model',),
+                 lambda: {(key,): int(breaker.state != CircuitBreaker.CLOSED)
+                          for key, breaker in model_router.breakers.items()})
+metrics.callback('telegram_send_queue_depth', 'Сообщения в очереди отправки', 'gauge', (),
+                 lambda: {(): send_scheduler.depth})
+metrics.callback('telegram_sent_total', 'Отправленные запросы к Bot API', 'counter', (),
+                 lambda: {(): send_scheduler.sent})
+metrics.callback('telegram_retry_after_total', 'Повторы после RetryAfter', 'counter', (),
+                 lambda: {(): send_scheduler.retried})
+metrics.callback('log_records_dropped_total', 'Отброшенные записи лога', 'counter', ('reason',),
+                 lambda: {('sampled',): _log_sampler().dropped_total, ('queue_full',): _log_queue_handler().dropped})
+metrics.callback('log_queue_depth', 'Записи лога в очереди', 'gauge', (),
+                 lambda: {(): _log_queue_handler().queue.qsize()})
+metrics.callback('tts_encoders_idle', 'Запущенные процессы ffmpeg в ожидании', 'gauge', (),
+                 lambda: {(): opus_encoder.idle})
+metrics.callback('tts_encoder_cold_starts_total', 'Запуски ffmpeg на пути ответа', 'counter', (),
+                 lambda: {(): opus_encoder.cold_starts})
+metrics.callback('tts_pending', 'Задачи синтеза речи в очереди', 'gauge', (), lambda: {(): _tts_pending})
+metrics.callback('bot_active_users', 'Пользователи, писавшие за окно', 'gauge', ('window',),
+                 lambda: {(name,): user_stats.active_users(seconds)
+                          for name, seconds in UserStatsStore.ACTIVE_WINDOWS.items()})
+metrics.callback('bot_user_messages_total', 'Сообщения пользователей', 'counter', (),
+                 lambda: {(): user_stats.total_messages})
+metrics.callback('bot_model_replies_total', 'Ответы по моделям', 'counter', ('model',),
+                 lambda: {(key,): count for key, count in user_stats.model_usage.items()})
+metrics.callback('state_pending_writes', 'Изменения, ожидающие записи', 'gauge', (),
+                 lambda: {(): state_writer.pending})
 
 # ==================== УТИЛИТЫ ====================
 async def text_to_speech(text: str, lang: str = 'ru') -> io.BytesIO:
     """Преобразует текст в голосовое сообщение"""
+    global _tts_pending
     try:
         # Ограничиваем длину текста для голосового сообщения
         if len(text) > 500:
             text = text[:497] + "..."
-            
-        tts = gTTS(text=text, lang=lang, slow=False)
-        mp3_fp = io.BytesIO()
-        tts.write_to_fp(mp3_fp)
-        mp3_fp.seek(0)
         
-        audio = AudioSegment.from_mp3(mp3_fp)
-        ogg_fp = io.BytesIO()
-        audio.export(ogg_fp, format="ogg")
-        ogg_fp.seek(0)
+        # Разные перекодировщики дают разные кодеки - не смешиваем их в кэше
+        key = AudioCache.make_key(text, lang, TTS_TRANSCODER)
+        cached = await audio_cache.get(key)
+        if cached is not None:
+            return io.BytesIO(cached)
+        
+        # Не копим бесконечную очередь: при перегрузке сразу отвечаем текстом
+        if _tts_pending >= TTS_MAX_PENDING:
+            logger.warning("⚠️ Очередь TTS переполнена, отвечаем текстом")
+            return None
+        
+        _tts_pending += 1
+        try:
+            async with _tts_slots:
+                loop = asyncio.get_running_loop()
+                started = time.perf_counter()
+                mp3_data = await loop.run_in_executor(_tts_fetch_pool, _fetch_mp3, text, lang)
+                fetched = time.perf_counter()
+                tts_stage_latency.observe(fetched - started, stage='fetch')
+                if TTS_TRANSCODER == 'pydub':
+                    ogg_data = await loop.run_in_executor(_get_transcode_pool(), _transcode_to_ogg, mp3_data)
+                else:
+                    ogg_data = await opus_encoder.transcode(mp3_data)
+                tts_stage_latency.observe(time.perf_counter() - fetched, stage='transcode')
+        finally:
+            _tts_pending -= 1
         
-        return ogg_fp
+        await audio_cache.put(key, ogg_data)
+        return io.BytesIO(ogg_data)
         
     except Exception as e:
         logger.error(f"❌ Ошибка TTS: {e}")
@@ -129,21 +2603,17 @@ async def text_to_speech(text: str, lang: str = 'ru') -> io.BytesIO:
 
 def update_user_stats(user_id: int):
     """Обновляет статистику пользователя"""
-    if user_id not in user_stats:
-        user_stats[user_id] = {
-            'first_seen': datetime.now(),
-            'message_count': 0,
-            'last_active': datetime.now()
-        }
-    user_stats[user_id]['message_count'] += 1
-    user_stats[user_id]['last_active'] = datetime.now()
+    user_stats.touch(user_id)
+    state_writer.mark_stats(user_id)
 
 # ==================== КОМАНДЫ БОТА ====================
+@track_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     try:
         user_id = update.effective_user.id
         user_models[user_id] = 'deepseek'
+        state_writer.mark_model(user_id)
         update_user_stats(user_id)
         
         welcome_text = (
@@ -164,41 +2634,43 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             'Просто напишите мне вопрос! 😊'
         )
         
-        await update.message.reply_text(welcome_text)
+        await send_reply(update, welcome_text)
         logger.info(f"🎯 Новый пользователь: {user_id}")
         
     except Exception as e:
         logger.error(f"❌ Ошибка в start: {e}")
-        await update.message.reply_text("⚠️ Произошла ошибка при запуске")
+        await send_reply(update, "⚠️ Произошла ошибка при запуске")
 
+@track_handler
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает статистику пользователя"""
     try:
         user_id = update.effective_user.id
         update_user_stats(user_id)
         
-        if user_id in user_stats:
-            stats = user_stats[user_id]
+        stats = user_stats.get(user_id)
+        if stats is not None:
             current_model = user_models.get(user_id, 'deepseek')
             model_name = AVAILABLE_MODELS[current_model]['name']
             
             stats_text = (
                 f"📊 **Ваша статистика:**\n\n"
                 f"• 🤖 **Модель по умолчанию:** {model_name}\n"
-                f"• 💬 **Отправлено сообщений:** {stats['message_count']}\n"
-                f"• 🕐 **Первое использование:** {stats['first_seen'].strftime('%d.%m.%Y %H:%M')}\n"
-                f"• ⏰ **Последняя активность:** {stats['last_active'].strftime('%d.%m.%Y %H:%M')}\n\n"
-                f"Всего пользователей: {len(user_stats)}"
+                f"• 💬 **Отправлено сообщений:** {stats.message_count}\n"
+                f"• 🕐 **Первое использование:** {datetime.fromtimestamp(stats.first_seen).strftime('%d.%m.%Y %H:%M')}\n"
+                f"• ⏰ **Последняя активность:** {datetime.fromtimestamp(stats.last_active).strftime('%d.%m.%Y %H:%M')}\n\n"
+                f"Всего пользователей: {len(user_stats)}, активных за сутки: {user_stats.active_users(86400)}"
             )
         else:
             stats_text = "📊 Статистика пока недоступна"
             
-        await update.message.reply_text(stats_text)
+        await send_reply(update, stats_text)
         
     except Exception as e:
         logger.error(f"❌ Ошибка в stats_command: {e}")
-        await update.message.reply_text("⚠️ Ошибка при получении статистики")
+        await send_reply(update, "⚠️ Ошибка при получении статистики")
 
+@track_handler
 async def models_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает список доступных моделей"""
     try:
@@ -212,12 +2684,13 @@ async def models_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             models_text += f"Описание: {model['description']}\n\n"
         
         models_text += "Используйте: `/model ключ` для выбора"
-        await update.message.reply_text(models_text)
+        await send_reply(update, models_text)
         
     except Exception as e:
         logger.error(f"❌ Ошибка в models_command: {e}")
-        await update.message.reply_text("⚠️ Ошибка при получении списка моделей")
+        await send_reply(update, "⚠️ Ошибка при получении списка моделей")
 
+@track_handler
 async def model_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Изменяет выбранную модель"""
     try:
@@ -225,7 +2698,8 @@ async def model_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         update_user_stats(user_id)
         
         if not context.args:
-            await update.message.reply_text(
+            await send_reply(
+                update,
                 "❌ Укажите модель. Например: `/model deepseek`\n"
                 "Посмотреть все модели: /models"
             )
@@ -234,16 +2708,19 @@ async def model_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         model_key = context.args[0].lower()
         
         if model_key not in AVAILABLE_MODELS:
-            await update.message.reply_text(
+            await send_reply(
+                update,
                 f"❌ Модель `{model_key}` не найдена.\n"
                 "Посмотреть доступные модели: /models"
             )
             return
         
         user_models[user_id] = model_key
+        state_writer.mark_model(user_id)
         model_info = AVAILABLE_MODELS[model_key]
         
-        await update.message.reply_text(
+        await send_reply(
+            update,
             f"✅ **Модель изменена на:** {model_info['name']}\n\n"
             f"{model_info['description']}\n\n"
             f"Теперь я буду использовать {model_info['name']} для ответов!"
@@ -252,8 +2729,9 @@ async def model_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     except Exception as e:
         logger.error(f"❌ Ошибка в model_command: {e}")
-        await update.message.reply_text("⚠️ Ошибка при смене модели")
+        await send_reply(update, "⚠️ Ошибка при смене модели")
 
+@track_handler
 async def current_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает текущую модель"""
     try:
@@ -263,7 +2741,8 @@ async def current_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         current_model_key = user_models.get(user_id, 'deepseek')
         model_info = AVAILABLE_MODELS[current_model_key]
         
-        await update.message.reply_text(
+        await send_reply(
+            update,
             f"🔮 **Текущая модель:** {model_info['name']}\n"
             f"📝 **Описание:** {model_info['description']}\n\n"
             "Изменить модель: /models"
@@ -271,8 +2750,9 @@ async def current_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
     except Exception as e:
         logger.error(f"❌ Ошибка в current_command: {e}")
-        await update.message.reply_text("⚠️ Ошибка при получении текущей модели")
+        await send_reply(update, "⚠️ Ошибка при получении текущей модели")
 
+@track_handler
 async def voice_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Преобразует текст в голосовое сообщение"""
     try:
@@ -281,7 +2761,8 @@ async def voice_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_message = ' '.join(context.args)
         
         if not user_message:
-            await update.message.reply_text(
+            await send_reply(
+                update,
                 "🎤 **Голосовые ответы**\n\n"
                 "Напишите текст после команды:\n"
                 "`/voice Привет! Как дела?`\n\n"
@@ -289,115 +2770,180 @@ async def voice_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="record_voice")
+        await send_scheduler.chat_action(context.bot, update.effective_chat.id, "record_voice")
         
         # Получаем ответ от AI
         current_model_key = user_models.get(user_id, 'deepseek')
-        model_id = AVAILABLE_MODELS[current_model_key]['id']
         model_name = AVAILABLE_MODELS[current_model_key]['name']
         
-        headers = {
-            'Authorization': f'Bearer {OPENROUTER_API_KEY}',
-            'Content-Type': 'application/json'
-        }
+        try:
+            ai_response, answered_key = await request_completion(
+                current_model_key,
+                conversation_history.build_messages(user_id, user_message, current_model_key, 500),
+                max_tokens=500
+            )
+        except (OpenRouterError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"⚠️ OpenRouter недоступен для /voice: {e}")
+            await send_reply(update, "❌ Ошибка подключения к AI. Попробуйте позже.")
+            return
         
-        data = {
-            'model': model_id,
-            'messages': [{'role': 'user', 'content': user_message}],
-            'max_tokens': 500
-        }
+        remember_turn(user_id, user_message, ai_response)
+        user_stats.record_model(answered_key)
+        model_name = model_router.describe(current_model_key, answered_key)
         
-        response = requests.post(
-            'https://openrouter.ai/api/v1/chat/completions', 
-            headers=headers, 
-            json=data,
-            timeout=30
-        )
+        # Преобразуем ответ в голос
+        voice_audio = await text_to_speech(ai_response)
         
-        if response.status_code == 200:
-            result = response.json()
-            ai_response = result['choices'][0]['message']['content']
-            
-            # Преобразуем ответ в голос
-            voice_audio = await text_to_speech(ai_response)
-            
-            if voice_audio:
-                await update.message.reply_voice(
-                    voice=voice_audio,
-                    caption=f"🎤 {model_name}: {ai_response}"
+        if voice_audio:
+            caption = f"🎤 {model_name}: {ai_response}"
+            # Байты, а не BytesIO: после RetryAfter файл загружается заново,
+            # а прочитанный до конца поток ушёл бы пустым
+            voice_data = voice_audio.getvalue()
+            await send_scheduler.submit(
+                update.effective_chat.id,
+                lambda: update.message.reply_voice(
+                    voice=voice_data,
+                    caption=caption[:TELEGRAM_CAPTION_LIMIT - 1] + '…' if len(caption) > TELEGRAM_CAPTION_LIMIT else caption
                 )
-                logger.info(f"🎤 Отправлен голосовой ответ пользователю {user_id}")
-            else:
-                await update.message.reply_text(f"🤖 {model_name}:\n\n{ai_response}")
+            )
+            # Подпись ограничена 1024 символами - полный текст отдельным сообщением
+            if len(caption) > TELEGRAM_CAPTION_LIMIT:
+                await send_reply(update, f"🤖 {model_name}:\n\n{ai_response}")
+            logger.info(f"🎤 Отправлен голосовой ответ пользователю {user_id}")
         else:
-            await update.message.reply_text("❌ Ошибка подключения к AI. Попробуйте позже.")
+            await send_reply(update, f"🤖 {model_name}:\n\n{ai_response}")
             
     except Exception as e:
         logger.error(f"❌ Ошибка в voice_command: {e}")
-        await update.message.reply_text("⚠️ Произошла ошибка при создании голосового сообщения")
+        await send_reply(update, "⚠️ Произошла ошибка при создании голосового сообщения")
 
+@track_handler
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает текстовые сообщения"""
+    update_user_stats(update.effective_user.id)
+    text = message_batcher.text_for(update)
+    if text is None:
+        # Сообщение ушло в модель в пачке с предыдущими - ответ будет на первое
+        return
+    await answer_with_llm(update, context, text)
+
+async def answer_with_llm(update: Update, context: ContextTypes.DEFAULT_TYPE, user_message: str):
+    """Отвечает на вопрос пользователя выбранной моделью"""
+    reply = None
     try:
         user_id = update.effective_user.id
-        user_message = update.message.text
-        update_user_stats(user_id)
         
         # Получаем выбранную модель пользователя
         current_model_key = user_models.get(user_id, 'deepseek')
         model_id = AVAILABLE_MODELS[current_model_key]['id']
         model_name = AVAILABLE_MODELS[current_model_key]['name']
         
-        # Показываем что бот "печатает"
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
+        messages = conversation_history.build_messages(user_id, user_message, current_model_key, 1000)
         
-        # Отправляем запрос к выбранной модели через OpenRouter
-        headers = {
-            'Authorization': f'Bearer {OPENROUTER_API_KEY}',
-            'Content-Type': 'application/json'
-        }
-        
-        data = {
-            'model': model_id,
-            'messages': [
-                {'role': 'user', 'content': user_message}
-            ],
-            'max_tokens': 1000
-        }
+        # Отправляем запрос к выбранной модели через общий пул соединений
+        cache_key = response_cache.key_for(current_model_key, messages, 1000)
+        flight_key = completion_key(model_id, messages, 1000)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            # Ответ из кэша уходит сразу, без запросов к Telegram до него
+            bot_response, answered_key = cached, current_model_key
+        else:
+            # Показываем что бот "печатает"
+            await send_scheduler.chat_action(context.bot, update.effective_chat.id, "typing")
+            if STREAMING_ENABLED and not inflight_requests.in_flight(flight_key):
+                reply = StreamingReply(update.message, f"🤖 {model_name}:\n\n")
+                bot_response, answered_key = await inflight_requests.do(
+                    flight_key,
+                    lambda: stream_completion(reply, current_model_key, messages, max_tokens=1000)
+                )
+            else:
+                bot_response, answered_key = await request_completion(
+                    current_model_key, messages, max_tokens=1000, cache_checked=True
+                )
         
-        response = requests.post(
-            'https://openrouter.ai/api/v1/chat/completions', 
-            headers=headers, 
-            json=data,
-            timeout=30
-        )
+        # Сохраняем в историю сам ответ модели, без оформления
+        remember_turn(user_id, user_message, bot_response)
+        user_stats.record_model(answered_key)
+        model_name = model_router.describe(current_model_key, answered_key)
         
-        if response.status_code == 200:
-            result = response.json()
-            bot_response = result['choices'][0]['message']['content']
-            # Без звёздочек в форматировании
-            bot_response = f"🤖 {model_name}:\n\n{bot_response}"
-            
-            # Сохраняем в историю
-            if user_id not in conversation_history:
-                conversation_history[user_id] = []
-            conversation_history[user_id].append({
-                'question': user_message,
-                'answer': bot_response,
-                'timestamp': datetime.now()
-            })
-            
-        else:
-            bot_response = f"❌ Ошибка подключения к {model_name}. Попробуйте позже."
+        # Без звёздочек в форматировании
+        bot_response = f"🤖 {model_name}:\n\n{bot_response}"
             
-    except requests.exceptions.Timeout:
+    except asyncio.TimeoutError:
         bot_response = "⏰ Таймаут при подключении к AI. Попробуйте позже."
+    except (OpenRouterError, aiohttp.ClientConnectionError) as e:
+        logger.warning(f"⚠️ OpenRouter недоступен: {e}")
+        bot_response = f"❌ Ошибка подключения к {model_name}. Попробуйте позже."
     except Exception as e:
-        logger.error(f"❌ Ошибка в handle_message: {e}")
+        logger.error(f"❌ Ошибка в answer_with_llm: {e}")
         bot_response = f"⚠️ Ошибка в модели {model_name}: {str(e)}"
     
-    await update.message.reply_text(bot_response)
+    if reply is not None and reply.started:
+        # Ответ уже показан по частям - ошибку дописываем в то же сообщение
+        if not reply.finished:
+            await reply.abort(bot_response)
+        return
+    
+    await send_reply(update, bot_response)
+
+@track_handler
+async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Распознаёт голосовое сообщение и отвечает на него как на текст"""
+    try:
+        user_id = update.effective_user.id
+        update_user_stats(user_id)
+        voice = update.message.voice
+        
+        # duration - int или timedelta (PTB_TIMEDELTA=1 и следующие версии PTB)
+        if to_seconds(voice.duration) > VOICE_MAX_DURATION or (voice.file_size or 0) > VOICE_MAX_FILE_SIZE:
+            await send_reply(
+                update,
+                f"⏱ Голосовое слишком длинное. Максимум - {int(VOICE_MAX_DURATION)} секунд."
+            )
+            return
+        
+        # Без распознавателя не качаем файл зря
+        try:
+            await get_stt_backend()
+        except SpeechToTextUnavailable:
+            await send_reply(update, "🎤 Распознавание речи не настроено на этом сервере. Напишите, пожалуйста, текстом.")
+            return
+        
+        if _voice_slots.locked():
+            logger.info(f"⏳ Голосовое от {user_id} ждёт свободного распознавателя")
+        
+        async with _voice_slots:
+            await send_scheduler.chat_action(context.bot, update.effective_chat.id, "typing")
+            voice_file = await context.bot.get_file(voice.file_id)
+            text = await asyncio.wait_for(
+                transcribe_voice(voice_file.file_path),
+                timeout=VOICE_TIMEOUT
+            )
+        
+        if not text:
+            await send_reply(update, "🤷 Не удалось разобрать речь. Попробуйте ещё раз.")
+            return
+        
+        logger.info(f"🎤 Распознано голосовое от {user_id}: {len(text)} символов")
+        await send_reply(update, f"🎤 Вы сказали: {text}")
+        
+    except VoiceTooLongError:
+        await send_reply(
+            update,
+            f"⏱ Голосовое слишком длинное. Максимум - {int(VOICE_MAX_DURATION)} секунд."
+        )
+        return
+    except asyncio.TimeoutError:
+        await send_reply(update, "⏰ Распознавание заняло слишком много времени. Попробуйте короче.")
+        return
+    except Exception as e:
+        logger.error(f"❌ Ошибка в handle_voice_message: {e}")
+        await send_reply(update, "⚠️ Не удалось обработать голосовое сообщение")
+        return
+    
+    await answer_with_llm(update, context, text)
 
+@track_handler
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает справку"""
     try:
@@ -412,7 +2958,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "/current - текущая модель\n"
             "/voice <текст> - голосовой ответ\n"
             "/stats - ваша статистика\n"
-            "/help - эта справка\n\n"
+            "/help - эта справка\n"
+            "🎤 Голосовое сообщение - распознаю и отвечу\n\n"
             "**Примеры:**\n"
             "`/model gpt` - переключиться на GPT\n"
             "`/model claude` - использовать Claude\n"
@@ -421,12 +2968,13 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "**Просто напишите вопрос** - и я отвечу! 🚀"
         )
         
-        await update.message.reply_text(help_text)
+        await send_reply(update, help_text)
         
     except Exception as e:
         logger.error(f"❌ Ошибка в help_command: {e}")
-        await update.message.reply_text("⚠️ Ошибка при показе справки")
+        await send_reply(update, "⚠️ Ошибка при показе справки")
 
+@track_handler
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Глобальный обработчик ошибок"""
     error = context.error
@@ -434,14 +2982,855 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         if update and update.effective_message:
-            await update.effective_message.reply_text(
+            await send_reply(
+                update,
                 "😔 Произошла непредвиденная ошибка. "
                 "Попробуйте еще раз или используйте команду /help"
             )
     except Exception as e:
         logger.error(f"❌ Ошибка при отправке сообщения об ошибке: {e}")
 
+# ==================== ОБРАБОТКА АПДЕЙТОВ ====================
+class MessageBatch:
+    """Сообщения одного чата, которые уйдут в модель одним запросом"""
+
+    __slots__ = ('leader', 'texts', 'deadline', 'closed', 'timer')
+
+    def __init__(self, leader: int, text: str, deadline: float):
+        self.leader = leader  # update_id апдейта, который ответит за всю пачку
+        self.texts = [text]
+        self.deadline = deadline
+        self.closed = asyncio.Event()
+        self.timer = None
+
+class MessageBatcher:
+    """Склеивает несколько сообщений подряд из одного чата в один запрос к модели.
+
+    Первое текстовое сообщение открывает окно, каждое следующее продлевает его
+    на window секунд, но не дольше max_wait от первого и не больше max_batch
+    сообщений. Команда или любой другой апдейт чата закрывает окно сразу.
+    Отвечает первый апдейт пачки, остальные только учитываются в статистике.
+    """
+
+    def __init__(self, window: float = DEBOUNCE_WINDOW, max_wait: float = DEBOUNCE_MAX_WAIT,
+                 max_batch: int = DEBOUNCE_MAX_BATCH):
+        self.window = window
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.batches = 0
+        self.absorbed = 0
+        self._open = {}  # chat_id -> MessageBatch, пока окно открыто
+        self._leaders = {}  # update_id -> MessageBatch
+        self._absorbed = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0 and self.max_batch > 1
+
+    @staticmethod
+    def batchable(update: Update) -> bool:
+        message = update.message
+        return bool(message and message.text and not message.text.startswith('/'))
+
+    def offer(self, update: Update) -> MessageBatch:
+        """Вызывается при поступлении апдейта; возвращает пачку, если апдейт её открыл"""
+        chat_id = update.effective_chat.id
+        batch = self._open.get(chat_id)
+        if not self.batchable(update):
+            if batch is not None:
+                self._close(chat_id, batch)
+            return None
+        
+        if batch is not None:
+            batch.texts.append(update.message.text)
+            self._absorbed.add(update.update_id)
+            self.absorbed += 1
+            if len(batch.texts) >= self.max_batch:
+                self._close(chat_id, batch)
+            else:
+                self._schedule(chat_id, batch)
+            return None
+        
+        batch = MessageBatch(update.update_id, update.message.text,
+                             asyncio.get_running_loop().time() + self.max_wait)
+        self._open[chat_id] = batch
+        self._leaders[update.update_id] = batch
+        self.batches += 1
+        self._schedule(chat_id, batch)
+        return batch
+
+    def _schedule(self, chat_id: int, batch: MessageBatch):
+        loop = asyncio.get_running_loop()
+        if batch.timer is not None:
+            batch.timer.cancel()
+        delay = max(0.0, min(self.window, batch.deadline - loop.time()))
+        batch.timer = loop.call_later(delay, self._close, chat_id, batch)
+
+    def _close(self, chat_id: int, batch: MessageBatch):
+        if batch.timer is not None:
+            batch.timer.cancel()
+        if self._open.get(chat_id) is batch:
+            del self._open[chat_id]
+        batch.closed.set()
+
+    def text_for(self, update: Update) -> str:
+        """Текст для модели: вся пачка для первого апдейта, None для поглощённых"""
+        batch = self._leaders.pop(update.update_id, None)
+        if batch is not None:
+            return '\n'.join(batch.texts)
+        if update.update_id in self._absorbed:
+            self._absorbed.discard(update.update_id)
+            return None
+        return update.message.text
+
+message_batcher = MessageBatcher()
+
+metrics.callback('bot_message_batches_total', 'Пачки сообщений, ушедшие одним запросом', 'counter', (),
+                 lambda: {(): message_batcher.batches})
+metrics.callback('bot_messages_absorbed_total', 'Сообщения, присоединённые к пачке', 'counter', (),
+                 lambda: {(): message_batcher.absorbed})
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает апдейты разных чатов параллельно, а одного чата - строго по очереди.
+
+    Тяжёлые апдейты (LLM, TTS) ограничены общим лимитом concurrency, лёгкие
+    команды из FAST_LANE_COMMANDS выполняются сразу, мимо лимита и очереди чата.
+    """
+
+    def __init__(self, concurrency: int = CONCURRENT_UPDATES,
+                 max_pending: int = MAX_PENDING_UPDATES,
+                 fast_commands: frozenset = FAST_LANE_COMMANDS):
+        # Базовый семафор только страхует от бесконечного числа задач:
+        # ожидающие своей очереди апдейты не должны занимать место быстрых команд
+        super().__init__(max_concurrent_updates=max(max_pending, concurrency, 2))
+        self.concurrency = concurrency
+        self.fast_commands = fast_commands
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tails = {}  # chat_id -> Future последнего апдейта чата
+
+    def is_fast(self, update: object) -> bool:
+        if not isinstance(update, Update) or not update.message or not update.message.text:
+            return False
+        text = update.message.text
+        if not text.startswith('/'):
+            return False
+        command = text[1:].split(maxsplit=1)[0].split('@', 1)[0].lower() if len(text) > 1 else ''
+        return command in self.fast_commands
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        batch = None
+        if message_batcher.enabled and isinstance(update, Update) and update.effective_chat:
+            # Раньше очереди чата: сообщение должно попасть в открытую пачку сразу
+            batch = message_batcher.offer(update)
+        
+        if self.is_fast(update):
+            await coroutine
+            return
+        
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._slots:
+                await coroutine
+            return
+        
+        # Каждый апдейт чата ждёт завершения предыдущего
+        previous = self._tails.get(chat.id)
+        done = asyncio.get_running_loop().create_future()
+        self._tails[chat.id] = done
+        started = False
+        try:
+            if previous is not None:
+                await asyncio.wait({previous})
+            if batch is not None:
+                # Окно пачки ждём без слота - он нужен только для запроса к модели
+                await batch.closed.wait()
+            async with self._slots:
+                started = True
+                await coroutine
+        finally:
+            if not started:
+                coroutine.close()
+            done.set_result(None)
+            if self._tails.get(chat.id) is done:
+                del self._tails[chat.id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+# ==================== ВЕБХУК ====================
+async def webhook_home(request: web.Request) -> web.Response:
+    return web.Response(text="🤖 Multi-AI Bot is running! 🚀")
+
+async def webhook_health(request: web.Request) -> web.Response:
+    payload = health_payload()
+    dispatcher = request.app.get('dispatcher')
+    if dispatcher is not None:
+        payload['workers'] = dispatcher.status()
+        if not dispatcher.healthy:
+            payload['status'] = 'DEGRADED'
+            return web.json_response(payload, status=503)
+    return web.json_response(payload)
+
+async def webhook_ready(request: web.Request) -> web.Response:
+    payload = readiness_payload()
+    dispatcher = request.app.get('dispatcher')
+    ready = startup.ready and (dispatcher is None or dispatcher.ready)
+    if not ready:
+        payload['status'] = 'STARTING'
+    return web.json_response(payload, status=200 if ready else 503)
+
+async def webhook_stats(request: web.Request) -> web.Response:
+    dispatcher = request.app.get('dispatcher')
+    # Пользователей обслуживают воркеры - у ingress своих данных нет
+    payload = stats_payload() if dispatcher is None else dispatcher.stats()
+    return web.json_response(payload)
+
+async def webhook_metrics(request: web.Request) -> web.Response:
+    dispatcher = request.app.get('dispatcher')
+    text = metrics.render() if dispatcher is None else dispatcher.render_metrics()
+    return web.Response(body=text.encode('utf-8'), headers={'Content-Type': METRICS_CONTENT_TYPE})
+
+async def telegram_webhook(request: web.Request) -> web.Response:
+    """Принимает апдейт от Telegram и передаёт его dispatch_update"""
+    if WEBHOOK_SECRET:
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token, WEBHOOK_SECRET):
+            return web.Response(status=403)
+    
+    try:
+        data = await request.json()
+        if not isinstance(data, dict):
+            raise TypeError(f"ожидался объект, получено {type(data).__name__}")
+        request.app['dispatch_update'](data)
+    except (ValueError, TypeError, AttributeError) as e:
+        logger.warning(f"⚠️ Некорректный апдейт от вебхука: {e}")
+        return web.Response(status=400)
+    except (asyncio.QueueFull, queue.Full):
+        # Telegram повторит доставку позже
+        logger.warning("⚠️ Очередь апдейтов переполнена")
+        return web.Response(status=503)
+    return web.Response()
+
+def application_dispatcher(application: Application):
+    """dispatch_update, кладущий апдейт в очередь приложения этого процесса"""
+    def dispatch_update(data: dict):
+        application.update_queue.put_nowait(Update.de_json(data, application.bot))
+    return dispatch_update
+
+def create_web_app(dispatch_update=None, dispatcher=None) -> web.Application:
+    """HTTP-сервер: /healthz, /stats, /metrics и вебхук Telegram в одном event loop.
+
+    Маршрут вебхука добавляется, только если передан dispatch_update.
+    """
+    web_app = web.Application()
+    web_app['dispatcher'] = dispatcher
+    web_app.router.add_get('/', webhook_home)
+    web_app.router.add_get('/healthz', webhook_health)
+    web_app.router.add_get('/readyz', webhook_ready)
+    web_app.router.add_get('/stats', webhook_stats)
+    web_app.router.add_get('/metrics', webhook_metrics)
+    if dispatch_update is not None:
+        web_app['dispatch_update'] = dispatch_update
+        web_app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    return web_app
+
+async def run_webhook(application: Application):
+    """Запускает бота в режиме вебхука и работает до SIGINT/SIGTERM"""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    runner = web.AppRunner(create_web_app(application_dispatcher(application)), access_log=None)
+    try:
+        await application.start()
+        await runner.setup()
+        await web.TCPSite(runner, '0.0.0.0', HTTP_PORT).start()
+        logger.info(f"✅ HTTP сервер вебхука запущен на порту {HTTP_PORT}")
+        
+        await application.bot.set_webhook(
+            url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=True
+        )
+        startup.mark('start_webhook')
+        on_ready(application)
+        logger.info("🤖 Бот успешно запущен в режиме вебхука!")
+        await stop_event.wait()
+    finally:
+        startup.set_not_ready()
+        await runner.cleanup()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+# ==================== НЕСКОЛЬКО ПРОЦЕССОВ ====================
+def shard_for(data: dict, count: int) -> int:
+    """Номер воркера для апдейта: по user_id, а без отправителя - по чату.
+
+    Все апдейты одного пользователя попадают в один процесс, поэтому
+    user_models, user_stats и история остаются локальными для воркера.
+    """
+    if count <= 1:
+        return 0
+    key = data.get('update_id', 0)
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        sender = value.get('from') or value.get('user')
+        if sender and 'id' in sender:
+            key = sender['id']
+            break
+        chat = value.get('chat')
+        if chat and 'id' in chat:
+            key = chat['id']
+            break
+    return key % count
+
+class WorkerHandle:
+    """Процесс-воркер, его входная очередь и время последнего heartbeat"""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self.queue = None
+        self.last_heartbeat = 0.0
+        self.backlog = 0
+        self.restarts = 0
+        self.failures = 0  # Падений подряд - от них растёт пауза перед перезапуском
+        self.started_at = 0.0
+        self.restart_at = None  # Когда перезапустить упавший воркер
+        self.buffer = deque()  # Апдейты, не влезшие в очередь: ждут в ingress, а не блокируют других
+        self.ready = False  # Прислал heartbeat после последнего запуска
+        self.stats = None  # Последние stats_payload() и metrics.render() воркера
+        self.metrics_text = ''
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def queue_depth(self) -> int:
+        try:
+            return self.queue.qsize() if self.queue is not None else 0
+        except NotImplementedError:
+            return 0
+
+class ShardedDispatcher:
+    """Ingress-процесс: раздаёт апдейты воркерам и следит за их здоровьем.
+
+    Каждый воркер - отдельный процесс со своим Application и своим GIL.
+    Апдейты передаются словарями через multiprocessing.Queue, воркеры
+    раз в WORKER_HEARTBEAT_INTERVAL присылают heartbeat в общую очередь.
+    Упавший или зависший воркер перезапускается с новой очередью, при
+    падениях подряд - с растущей паузой. Если очередь воркера полна, апдейты
+    копятся в его буфере в ingress, не задерживая остальных воркеров.
+    Вместе с heartbeat воркер присылает снимок своих /stats и /metrics,
+    из которых ingress собирает общую статистику.
+    """
+
+    def __init__(self, count: int = BOT_WORKERS, queue_size: int = WORKER_QUEUE_SIZE,
+                 heartbeat_timeout: float = WORKER_HEARTBEAT_TIMEOUT):
+        self.count = count
+        self.queue_size = queue_size
+        self.heartbeat_timeout = heartbeat_timeout
+        # spawn: воркер не наследует потоки, event loop и сокеты ingress-процесса
+        self._ctx = multiprocessing.get_context('spawn')
+        self.status_queue = self._ctx.Queue()
+        self.workers = [WorkerHandle(index) for index in range(count)]
+        self.dispatched = 0
+        self._closing = False
+
+    @property
+    def healthy(self) -> bool:
+        return all(worker.alive for worker in self.workers)
+
+    @property
+    def ready(self) -> bool:
+        # Читаем свежие heartbeat, не дожидаясь цикла supervise
+        self._drain_status()
+        return all(worker.alive and worker.ready for worker in self.workers)
+
+    def start(self):
+        for worker in self.workers:
+            self._spawn(worker)
+
+    def _spawn(self, worker: WorkerHandle):
+        if worker.queue is not None:
+            lost = worker.queue_depth()
+            if lost:
+                logger.warning(f"⚠️ Воркер {worker.index}: потеряно {lost} апдейтов из очереди")
+            worker.queue.close()
+        # Старую очередь не переиспользуем: умерший воркер мог держать её блокировку
+        worker.queue = self._ctx.Queue(self.queue_size)
+        worker.process = self._ctx.Process(
+            target=run_worker,
+            args=(worker.index, self.count, worker.queue, self.status_queue),
+            name=f"bot-worker-{worker.index}"
+        )
+        # Свой лог-файл у каждого воркера: RotatingFileHandler не рассчитан на несколько процессов
+        base, ext = os.path.splitext(LOG_FILE)
+        previous = os.environ.get('LOG_FILE')
+        os.environ['LOG_FILE'] = f"{base}.worker{worker.index}{ext}"
+        try:
+            worker.process.start()
+        finally:
+            if previous is None:
+                os.environ.pop('LOG_FILE', None)
+            else:
+                os.environ['LOG_FILE'] = previous
+        worker.last_heartbeat = worker.started_at = time.monotonic()
+        worker.ready = False
+        logger.info(f"✅ Воркер {worker.index} запущен (pid {worker.process.pid})")
+
+    def dispatch(self, data: dict):
+        """Передаёт апдейт его воркеру; queue.Full - буфер воркера полон, пора притормозить"""
+        worker = self.workers[shard_for(data, self.count)]
+        if not worker.buffer:
+            try:
+                worker.queue.put_nowait(data)
+                self.dispatched += 1
+                return
+            except queue.Full:
+                pass
+        if len(worker.buffer) >= WORKER_BUFFER_SIZE:
+            raise queue.Full
+        # Порядок апдейтов воркера сохраняется: пока буфер не пуст, новые - в его конец
+        worker.buffer.append(data)
+        self.dispatched += 1
+
+    def _flush_buffer(self, worker: WorkerHandle):
+        while worker.buffer:
+            try:
+                worker.queue.put_nowait(worker.buffer[0])
+            except queue.Full:
+                return
+            worker.buffer.popleft()
+
+    async def pump(self, interval: float = 0.05):
+        """Досылает апдейты из буферов, когда в очередях воркеров освобождается место"""
+        while not self._closing:
+            for worker in self.workers:
+                if worker.buffer and worker.alive:
+                    self._flush_buffer(worker)
+            await asyncio.sleep(interval)
+
+    def _drain_status(self):
+        while True:
+            try:
+                kind, index, value = self.status_queue.get_nowait()
+            except queue.Empty:
+                return
+            worker = self.workers[index]
+            if kind == 'snapshot':
+                worker.stats, worker.metrics_text = value
+                continue
+            worker.last_heartbeat = time.monotonic()
+            worker.backlog = value
+            worker.ready = kind == 'heartbeat'
+            if kind == 'stopped':
+                logger.info(f"✅ Воркер {index} остановлен")
+
+    async def supervise(self, interval: float = WORKER_HEARTBEAT_INTERVAL):
+        """Перезапускает воркеры, которые умерли или перестали присылать heartbeat"""
+        while not self._closing:
+            await asyncio.sleep(interval)
+            self._drain_status()
+            now = time.monotonic()
+            for worker in self.workers:
+                if self._closing:
+                    return
+                if worker.restart_at is None:
+                    if not worker.alive:
+                        logger.error(f"❌ Воркер {worker.index} завершился с кодом {worker.process.exitcode}")
+                    elif now - worker.last_heartbeat > self.heartbeat_timeout:
+                        logger.error(f"❌ Воркер {worker.index} не отвечает {now - worker.last_heartbeat:.0f} с")
+                        worker.process.kill()
+                        await asyncio.get_running_loop().run_in_executor(None, worker.process.join)
+                    else:
+                        continue
+                    worker.restart_at = now + self._restart_delay(worker, now, interval)
+                if now < worker.restart_at:
+                    continue
+                worker.restart_at = None
+                worker.restarts += 1
+                worker_restarts.inc(worker=str(worker.index))
+                self._spawn(worker)
+
+    def _restart_delay(self, worker: WorkerHandle, now: float, interval: float) -> float:
+        """Первый перезапуск - сразу, при падениях подряд пауза удваивается"""
+        if now - worker.started_at > WORKER_RESTART_MAX_BACKOFF:
+            # Воркер успел поработать - прошлые падения не в счёт
+            worker.failures = 0
+        delay = min(interval * 2 ** (worker.failures - 1), WORKER_RESTART_MAX_BACKOFF) if worker.failures else 0.0
+        worker.failures += 1
+        if delay:
+            logger.warning(f"⚠️ Воркер {worker.index} падает {worker.failures}-й раз подряд, перезапуск через {delay:.0f} с")
+        return delay
+
+    async def drain(self, timeout: float = WORKER_DRAIN_TIMEOUT):
+        """Останавливает воркеры, давая им дообработать уже принятые апдейты"""
+        self._closing = True
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            if worker.alive:
+                # None в конце очереди: воркер сначала разберёт всё, что перед ним,
+                # включая остаток буфера
+                try:
+                    for data in [*worker.buffer, None]:
+                        await loop.run_in_executor(None, functools.partial(
+                            worker.queue.put, data, timeout=max(deadline - time.monotonic(), 0.1)
+                        ))
+                        if data is not None:
+                            worker.buffer.popleft()
+                except queue.Full:
+                    # Очередь так и не освободилась - остановим воркер по таймауту ниже
+                    logger.warning(f"⚠️ Воркер {worker.index}: очередь переполнена, сигнал остановки не доставлен")
+            if worker.buffer:
+                logger.warning(f"⚠️ Воркер {worker.index}: не доставлено {len(worker.buffer)} апдейтов из буфера")
+        for worker in self.workers:
+            await loop.run_in_executor(None, worker.process.join, max(deadline - time.monotonic(), 0))
+            if worker.process.is_alive():
+                logger.warning(f"⚠️ Воркер {worker.index} не успел дообработать апдейты, останавливаем")
+                worker.process.terminate()
+                await loop.run_in_executor(None, worker.process.join)
+        self._drain_status()
+
+    def stats(self) -> dict:
+        """stats_payload(), сложенный по всем воркерам"""
+        self._drain_status()
+        payload = merge_stats_payloads({
+            str(worker.index): worker.stats for worker in self.workers if worker.stats is not None
+        })
+        payload['workers'] = self.status()
+        return payload
+
+    def render_metrics(self) -> str:
+        """Метрики ingress и всех воркеров, у воркерных - метка worker"""
+        self._drain_status()
+        return merge_metrics([(None, metrics.render())] + [
+            (worker.index, worker.metrics_text) for worker in self.workers
+        ])
+
+    def status(self) -> list:
+        now = time.monotonic()
+        return [
+            {
+                "index": worker.index,
+                "pid": worker.process.pid if worker.process else None,
+                "alive": worker.alive,
+                "ready": worker.ready,
+                "restarts": worker.restarts,
+                "queue_depth": worker.queue_depth(),
+                "buffered": len(worker.buffer),
+                "backlog": worker.backlog,
+                "heartbeat_age": round(now - worker.last_heartbeat, 1)
+            }
+            for worker in self.workers
+        ]
+
+sharded_dispatcher = None
+
+def _worker_stats(func) -> dict:
+    if sharded_dispatcher is None:
+        return {}
+    return {(str(worker.index),): func(worker) for worker in sharded_dispatcher.workers}
+
+worker_restarts = metrics.counter('bot_worker_restarts_total', 'Перезапуски воркеров', ('worker',))
+metrics.callback('bot_worker_up', 'Воркер жив', 'gauge', ('worker',),
+                 lambda: _worker_stats(lambda worker: int(worker.alive)))
+metrics.callback('bot_worker_queue_depth', 'Апдейты в очереди воркера', 'gauge', ('worker',),
+                 lambda: _worker_stats(lambda worker: worker.queue_depth()))
+metrics.callback('bot_worker_buffered_updates', 'Апдейты в буфере ingress', 'gauge', ('worker',),
+                 lambda: _worker_stats(lambda worker: len(worker.buffer)))
+
+def run_worker(index: int, count: int, updates, status_queue):
+    """Точка входа процесса-воркера"""
+    # Ctrl+C приходит всей группе процессов - остановкой управляет ingress
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_worker_loop(index, count, updates, status_queue))
+
+async def _worker_loop(index: int, count: int, updates, status_queue):
+    global WORKER_SHARD, send_scheduler
+    WORKER_SHARD = (index, count)
+    # Глобальный лимит Telegram делится между всеми воркерами
+    send_scheduler = SendScheduler(global_rate=SEND_GLOBAL_RATE / count)
+    application = build_application(TELEGRAM_TOKEN)
+    startup.mark('build_application')
+    loop = asyncio.get_running_loop()
+    
+    async def heartbeat():
+        while True:
+            status_queue.put(('heartbeat', index, application.update_queue.qsize()))
+            status_queue.put(('snapshot', index, (stats_payload(), metrics.render())))
+            await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+    
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    beat = asyncio.create_task(heartbeat())
+    startup.mark('start')
+    on_ready(application)
+    logger.info(f"🤖 Воркер {index}/{count} готов к работе")
+    
+    # Блокирующий get - в отдельном потоке, чтобы не стоял event loop
+    reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='worker-queue')
+    try:
+        while True:
+            data = await loop.run_in_executor(reader, updates.get)
+            if data is None:
+                break
+            try:
+                update = Update.de_json(data, application.bot)
+            except (ValueError, TypeError) as e:
+                logger.warning(f"⚠️ Некорректный апдейт от ingress: {e}")
+                continue
+            await application.update_queue.put(update)
+    finally:
+        beat.cancel()
+        reader.shutdown(wait=False)
+        # stop() дожидается обработки всего, что уже в update_queue
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        status_queue.put(('stopped', index, 0))
+
+async def _get_updates(bot: Bot, **kwargs) -> tuple:
+    """getUpdates с повторами: RetryAfter выжидаем, прочие ошибки - с растущей паузой.
+
+    Наружу выходит только InvalidToken - с отозванным токеном повторять нечего.
+    """
+    backoff = 1.0
+    while True:
+        try:
+            return await bot.get_updates(**kwargs)
+        except InvalidToken:
+            raise
+        except RetryAfter as e:
+            retry_after = to_seconds(e.retry_after)
+            logger.warning(f"⚠️ Telegram просит подождать {retry_after} c перед getUpdates")
+            await asyncio.sleep(retry_after)
+            continue
+        except Conflict as e:
+            # Второй экземпляр бота с тем же токеном или не снятый вебхук
+            logger.error(f"❌ Конфликт getUpdates: {e}")
+        except TelegramError as e:
+            logger.warning(f"⚠️ Ошибка получения апдейтов: {e}")
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, POLL_MAX_BACKOFF)
+
+async def poll_updates(bot: Bot, dispatch_update, drop_pending: bool = True):
+    """Long polling в ingress-процессе: апдейты сразу уходят воркерам"""
+    offset = None
+    if drop_pending:
+        # Как drop_pending_updates=True: пропускаем накопившееся до запуска
+        pending = await _get_updates(bot, offset=-1, timeout=0)
+        offset = pending[-1].update_id + 1 if pending else None
+    while True:
+        batch = await _get_updates(bot, offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+        for update in batch:
+            offset = update.update_id + 1
+            data = update.to_dict()
+            while True:
+                try:
+                    dispatch_update(data)
+                    break
+                except queue.Full:
+                    # Буфер воркера полон - он давно не успевает; ждём, а не теряем апдейт
+                    await asyncio.sleep(0.1)
+
+async def run_sharded(worker_count: int = BOT_WORKERS):
+    """Ingress + N воркеров: polling или вебхук в этом процессе, обработка - в воркерах"""
+    global sharded_dispatcher
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    sharded_dispatcher = dispatcher = ShardedDispatcher(worker_count)
+    dispatcher.start()
+    supervisor = asyncio.create_task(dispatcher.supervise())
+    pump = asyncio.create_task(dispatcher.pump())
+    webhook = BOT_MODE == 'webhook'
+    runner = web.AppRunner(
+        create_web_app(dispatcher.dispatch if webhook else None, dispatcher), access_log=None
+    )
+    try:
+        await runner.setup()
+        await web.TCPSite(runner, '0.0.0.0', HTTP_PORT).start()
+        logger.info(f"✅ HTTP сервер ingress запущен на порту {HTTP_PORT}")
+        
+        async with Bot(TELEGRAM_TOKEN) as bot:
+            if webhook:
+                await bot.set_webhook(
+                    url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=Update.ALL_TYPES,
+                    drop_pending_updates=True
+                )
+                poller = None
+            else:
+                await bot.delete_webhook()
+                poller = asyncio.create_task(poll_updates(bot, dispatcher.dispatch))
+            logger.info(f"🤖 Бот запущен: {worker_count} воркеров, режим {BOT_MODE}")
+            while not dispatcher.ready and not stop_event.is_set():
+                await asyncio.sleep(0.1)
+            startup.mark('start_workers')
+            startup.set_ready()
+            stopping = asyncio.create_task(stop_event.wait())
+            while poller is not None:
+                await asyncio.wait({stopping, poller}, return_when=asyncio.FIRST_COMPLETED)
+                if stop_event.is_set():
+                    poller.cancel()
+                    break
+                # Polling умер - апдейты больше не приходят, снимаем готовность
+                startup.set_not_ready()
+                error = poller.exception()
+                if isinstance(error, InvalidToken):
+                    logger.error(f"❌ Telegram отклонил токен, останавливаем бота: {error}")
+                    stop_event.set()
+                    break
+                logger.error(f"❌ Polling упал: {error!r}, перезапуск через {POLL_RESTART_DELAY:.0f} с")
+                await asyncio.wait({stopping}, timeout=POLL_RESTART_DELAY)
+                if stop_event.is_set():
+                    break
+                # Неподтверждённые апдейты не отбрасываем - их могли ещё не отдать воркерам
+                poller = asyncio.create_task(poll_updates(bot, dispatcher.dispatch, drop_pending=False))
+                startup.set_ready()
+            await stopping
+    finally:
+        # Сначала перестаём принимать апдейты, потом даём воркерам их дообработать
+        startup.set_not_ready()
+        await runner.cleanup()
+        supervisor.cancel()
+        pump.cancel()
+        await dispatcher.drain()
+
 # ==================== ЗАПУСК БОТА ====================
+def _warm_transcoder() -> int:
+    """Поднимает процесс пула перекодирования и импортирует в нём pydub"""
+    importlib.import_module('pydub')
+    return os.getpid()
+
+async def prewarm_subsystems():
+    """Фоновый прогрев того, что иначе грузится на первом запросе пользователя"""
+    loop = asyncio.get_running_loop()
+    
+    async def warm_openrouter():
+        await loop.run_in_executor(None, aiohttp.load)
+        openrouter_client._get_session()
+    
+    async def warm_tts():
+        await loop.run_in_executor(_tts_fetch_pool, importlib.import_module, 'gtts')
+        if TTS_TRANSCODER != 'pydub':
+            await opus_encoder.fill()
+            return
+        pool = _get_transcode_pool()
+        await asyncio.gather(*(
+            loop.run_in_executor(pool, _warm_transcoder) for _ in range(TTS_TRANSCODE_WORKERS)
+        ))
+    
+    for phase, warm in (('prewarm_openrouter', warm_openrouter),
+                        ('prewarm_tts', warm_tts),
+                        ('prewarm_stt', get_stt_backend)):
+        started = time.perf_counter()
+        try:
+            await warm()
+        except Exception as e:
+            logger.warning(f"⚠️ Прогрев {phase} не удался: {e}")
+            continue
+        startup.record(phase, time.perf_counter() - started)
+    logger.info("🔥 Подсистемы прогреты")
+
+def on_ready(application: Application):
+    """Бот принимает апдейты: отмечаем готовность и прогреваем остальное в фоне"""
+    startup.set_ready()
+    if STARTUP_PREWARM:
+        application.bot_data['prewarm'] = asyncio.create_task(prewarm_subsystems())
+
+async def _wait_for_polling(application: Application):
+    # У run_polling нет хука после запуска - ждём, пока поднимутся updater и приложение
+    while not (application.running and application.updater.running):
+        await asyncio.sleep(0.05)
+    startup.mark('start_polling')
+    on_ready(application)
+
+async def post_init(application: Application):
+    """Загружает сохранённое состояние до приёма первых апдейтов"""
+    startup.mark('initialize')
+    await state_writer.load(WORKER_SHARD)
+    state_writer.start()
+    startup.mark('state_load')
+    application.bot_data['loop_lag_monitor'] = asyncio.create_task(monitor_event_loop_lag())
+    if BOT_MODE == 'polling' and WORKER_SHARD is None and application.updater is not None:
+        application.bot_data['ready_watch'] = asyncio.create_task(_wait_for_polling(application))
+
+async def post_shutdown(application: Application):
+    """Дописывает состояние и освобождает ресурсы при остановке бота"""
+    startup.set_not_ready()
+    for name in ('loop_lag_monitor', 'ready_watch', 'prewarm'):
+        task = application.bot_data.pop(name, None)
+        if task is not None:
+            task.cancel()
+    await state_writer.close()
+    await send_scheduler.close()
+    await openrouter_client.close()
+    await close_voice_pipeline()
+    await opus_encoder.close()
+    shutdown_tts_pools()
+
+def build_application(token: str, base_url: str = None, base_file_url: str = None) -> Application:
+    """Создаёт приложение бота со всеми обработчиками.
+
+    base_url и base_file_url позволяют направить Bot API на другой сервер,
+    например на локальную заглушку в benchmark.py.
+    """
+    builder = (
+        Application.builder()
+        .token(token)
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+        .concurrent_updates(ChatOrderedUpdateProcessor())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    if base_file_url:
+        builder = builder.base_file_url(base_file_url)
+    app_bot = builder.build()
+    
+    # Добавляем глобальный обработчик ошибок
+    app_bot.add_error_handler(error_handler)
+    
+    # Добавляем обработчики команд
+    handlers = [
+        CommandHandler("start", start),
+        CommandHandler("models", models_command),
+        CommandHandler("model", model_command),
+        CommandHandler("current", current_command),
+        CommandHandler("voice", voice_command),
+        CommandHandler("stats", stats_command),
+        CommandHandler("help", help_command),
+        MessageHandler(filters.VOICE, handle_voice_message),
+        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message)
+    ]
+    
+    for handler in handlers:
+        app_bot.add_handler(handler)
+    
+    return app_bot
+
 def main():
     """Основная функция запуска бота"""
     print("🚀 Запуск улучшенного мульти-AI бота...")
@@ -454,40 +3843,37 @@ def main():
         logger.error("❌ ОШИБКА: OPENROUTER_API_KEY не установлен!")
         return
     
+    if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+        logger.error("❌ ОШИБКА: для BOT_MODE=webhook нужен WEBHOOK_URL!")
+        return
+    
+    if BOT_WORKERS > 1:
+        # Ingress в этом процессе, обработчики - в BOT_WORKERS процессах-воркерах
+        asyncio.run(run_sharded(BOT_WORKERS))
+        return
+    
     try:
+        # Создаем и настраиваем бота
+        app_bot = build_application(TELEGRAM_TOKEN)
+        startup.mark('build_application')
+        
+        logger.info("✅ Все обработчики добавлены")
+        
+        if BOT_MODE == 'webhook':
+            # Вебхук, /healthz и /stats на одном event loop - без Flask и keep-alive
+            asyncio.run(run_webhook(app_bot))
+            return
+        
         # Запускаем Flask в отдельном потоке
         flask_thread = threading.Thread(target=run_flask)
         flask_thread.daemon = True
         flask_thread.start()
-        logger.info("✅ Flask сервер запущен на порту 5000")
+        logger.info(f"✅ Flask сервер запущен на порту {HTTP_PORT}")
         
         # Запускаем систему поддержания активности
         keep_bot_awake()
         logger.info("✅ Система keep-alive запущена")
         
-        # Создаем и настраиваем бота
-        app_bot = Application.builder().token(TELEGRAM_TOKEN).build()
-        
-        # Добавляем глобальный обработчик ошибок
-        app_bot.add_error_handler(error_handler)
-        
-        # Добавляем обработчики команд
-        handlers = [
-            CommandHandler("start", start),
-            CommandHandler("models", models_command),
-            CommandHandler("model", model_command),
-            CommandHandler("current", current_command),
-            CommandHandler("voice", voice_command),
-            CommandHandler("stats", stats_command),
-            CommandHandler("help", help_command),
-            MessageHandler(filters.VOICE, handle_voice_message),
-            MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message)
-        ]
-        
-        for handler in handlers:
-            app_bot.add_handler(handler)
-        
-        logger.info("✅ Все обработчики добавлены")
         logger.info("🤖 Бот успешно запущен и готов к работе!")
         
         # Запускаем бота
@@ -500,5 +3886,7 @@ def main():
         logger.error(f"💥 Критическая ошибка при запуске бота: {e}")
         raise
 
+startup.mark('module_init')
+
 if __name__ == '__main__':
     main()                     
@@ -0,0 +1,28 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Импорт main настраивает логирование - пишем лог тестов во временный каталог
+os.environ.setdefault('LOG_FILE', os.path.join(tempfile.gettempdir(), 'bot-tests.log'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update
+
+
+@pytest.fixture
+def make_update():
+    """Апдейт с текстовым сообщением, как его присылает Telegram"""
+    def make(update_id: int, chat_id: int, text: str) -> Update:
+        return Update.de_json({
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': 0,
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Тест'},
+                'text': text
+            }
+        }, None)
+    return make
@@ -0,0 +1,93 @@
+import asyncio
+import time
+
+import main
+
+
+def open_breaker(**kwargs) -> main.CircuitBreaker:
+    breaker = main.CircuitBreaker(window=60, min_requests=3, error_rate=0.5, cooldown=0.05, **kwargs)
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.record(False, 0.1)
+    return breaker
+
+
+def test_errors_open_the_breaker():
+    breaker = open_breaker()
+    assert breaker.state == breaker.OPEN
+    assert not breaker.allow()
+
+
+def test_half_open_lets_one_probe_through_and_closes_on_success():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == breaker.HALF_OPEN
+    # Пока пробный запрос в пути, остальные не пропускаются
+    assert not breaker.allow()
+    breaker.record(True, 0.1)
+    assert breaker.state == breaker.CLOSED
+    assert breaker.allow()
+
+
+def test_failed_probe_reopens_the_breaker():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record(False, 0.1)
+    assert breaker.state == breaker.OPEN
+    assert not breaker.allow()
+
+
+def test_released_probe_can_be_taken_again():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.allow()
+
+
+def test_slow_calls_open_the_breaker():
+    breaker = main.CircuitBreaker(window=60, min_requests=3, slow_call=1, slow_rate=0.5, cooldown=30)
+    for _ in range(3):
+        breaker.record(True, 2)
+    assert breaker.state == breaker.OPEN
+
+
+class FailingClient:
+    def __init__(self, status: int):
+        self.status = status
+        self.calls = 0
+
+    async def chat_completion(self, model_id, messages, max_tokens):
+        self.calls += 1
+        raise main.OpenRouterError(self.status, 'ошибка')
+
+
+def test_client_errors_do_not_trip_breakers_or_fall_back():
+    async def scenario():
+        client = FailingClient(400)
+        router = main.ModelRouter(client, ['deepseek', 'gpt', 'claude'])
+        for _ in range(10):
+            try:
+                await router.complete('deepseek', [], 10)
+            except main.OpenRouterError:
+                pass
+        return client.calls, router
+
+    calls, router = asyncio.run(scenario())
+    assert calls == 10
+    assert all(breaker.state == breaker.CLOSED for breaker in router.breakers.values())
+
+
+def test_upstream_errors_fall_back_to_the_next_model():
+    async def scenario():
+        client = FailingClient(503)
+        router = main.ModelRouter(client, ['deepseek', 'gpt'])
+        try:
+            await router.complete('deepseek', [], 10)
+        except main.OpenRouterError:
+            pass
+        return client.calls, router.fallbacks
+
+    assert asyncio.run(scenario()) == (2, 1)
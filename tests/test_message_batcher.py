@@ -0,0 +1,73 @@
+import asyncio
+
+import main
+
+
+def test_window_joins_messages_into_one_batch(make_update):
+    async def scenario():
+        batcher = main.MessageBatcher(window=0.05, max_wait=1, max_batch=5)
+        first, second = make_update(1, 1, "привет"), make_update(2, 1, "как дела?")
+        batch = batcher.offer(first)
+        assert batcher.offer(second) is None
+        assert not batch.closed.is_set()
+        await asyncio.wait_for(batch.closed.wait(), timeout=1)
+        return batcher.text_for(first), batcher.text_for(second)
+
+    assert asyncio.run(scenario()) == ("привет\nкак дела?", None)
+
+
+def test_max_wait_closes_a_batch_that_keeps_growing(make_update):
+    async def scenario():
+        batcher = main.MessageBatcher(window=0.05, max_wait=0.1, max_batch=100)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        batch = batcher.offer(make_update(1, 1, "0"))
+        for i in range(2, 10):
+            # Каждое сообщение продлевает окно, но не дальше max_wait от первого
+            await asyncio.sleep(0.03)
+            if batch.closed.is_set():
+                break
+            batcher.offer(make_update(i, 1, str(i)))
+        await asyncio.wait_for(batch.closed.wait(), timeout=1)
+        return loop.time() - started, len(batch.texts)
+
+    elapsed, size = asyncio.run(scenario())
+    assert elapsed < 0.2
+    assert 1 < size < 9
+
+
+def test_max_batch_closes_immediately(make_update):
+    async def scenario():
+        batcher = main.MessageBatcher(window=10, max_wait=10, max_batch=3)
+        batch = batcher.offer(make_update(1, 1, "a"))
+        batcher.offer(make_update(2, 1, "b"))
+        assert not batch.closed.is_set()
+        batcher.offer(make_update(3, 1, "c"))
+        return batch.closed.is_set(), batcher.offer(make_update(4, 1, "d")) is not None
+
+    closed, new_batch = asyncio.run(scenario())
+    assert closed
+    assert new_batch
+
+
+def test_command_closes_batch_and_is_not_absorbed(make_update):
+    async def scenario():
+        batcher = main.MessageBatcher(window=10, max_wait=10, max_batch=5)
+        batch = batcher.offer(make_update(1, 1, "вопрос"))
+        command = make_update(2, 1, "/models")
+        assert batcher.offer(command) is None
+        return batch.closed.is_set(), batcher.text_for(command)
+
+    closed, text = asyncio.run(scenario())
+    assert closed
+    assert text == "/models"
+
+
+def test_chats_are_batched_separately(make_update):
+    async def scenario():
+        batcher = main.MessageBatcher(window=10, max_wait=10, max_batch=5)
+        first = batcher.offer(make_update(1, 1, "a"))
+        second = batcher.offer(make_update(2, 2, "b"))
+        return first is not second and second is not None
+
+    assert asyncio.run(scenario())
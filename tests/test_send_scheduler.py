@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+from telegram.error import RetryAfter
+
+import main
+
+
+def test_messages_of_one_chat_are_sent_in_order():
+    async def scenario():
+        scheduler = main.SendScheduler(global_rate=1000, chat_rate=1000, chat_burst=100)
+        sent = []
+
+        def factory(i):
+            async def send():
+                # Первые отправки дольше - порядок не должен от этого зависеть
+                await asyncio.sleep(0.01 * (5 - i))
+                sent.append(i)
+                return i
+            return send
+
+        results = await asyncio.gather(*(scheduler.submit(1, factory(i)) for i in range(5)))
+        await scheduler.close()
+        return sent, results
+
+    sent, results = asyncio.run(scenario())
+    assert sent == [0, 1, 2, 3, 4]
+    assert results == [0, 1, 2, 3, 4]
+
+
+def test_retry_after_pauses_chat_and_retries_in_place():
+    async def scenario():
+        scheduler = main.SendScheduler(global_rate=1000, chat_rate=1000, chat_burst=100)
+        attempts = []
+
+        def factory(name, failures):
+            async def send():
+                attempts.append(name)
+                if attempts.count(name) <= failures:
+                    raise RetryAfter(0.05)
+                return name
+            return send
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        results = await asyncio.gather(
+            scheduler.submit(1, factory('first', 1)),
+            scheduler.submit(1, factory('second', 0)),
+        )
+        elapsed = loop.time() - started
+        await scheduler.close()
+        return attempts, results, elapsed, scheduler.retried
+
+    attempts, results, elapsed, retried = asyncio.run(scenario())
+    # Повтор первого уходит раньше второго сообщения, и только после паузы
+    assert attempts == ['first', 'first', 'second']
+    assert results == ['first', 'second']
+    assert retried == 1
+    assert elapsed >= 0.05
+
+
+def test_retry_after_gives_up_after_max_retries():
+    async def scenario():
+        scheduler = main.SendScheduler(global_rate=1000, chat_rate=1000, chat_burst=100, max_retries=2)
+        calls = 0
+
+        async def send():
+            nonlocal calls
+            calls += 1
+            raise RetryAfter(0.01)
+
+        try:
+            with pytest.raises(RetryAfter):
+                await scheduler.submit(1, send)
+        finally:
+            await scheduler.close()
+        return calls
+
+    assert asyncio.run(scenario()) == 3
+
+
+def test_split_message_keeps_code_fences_balanced():
+    text = "Начало\n```\n" + "\n".join(f"line {i}" for i in range(200)) + "\n```\nКонец"
+    parts = main.split_message(text, limit=300)
+    assert len(parts) > 1
+    assert all(len(part) <= 300 for part in parts)
+    assert all(part.count('```') % 2 == 0 for part in parts)
@@ -0,0 +1,73 @@
+import asyncio
+
+import main
+
+
+async def record(log: list, name: str, delay: float = 0):
+    log.append(('start', name))
+    await asyncio.sleep(delay)
+    log.append(('end', name))
+
+
+def test_updates_of_one_chat_run_in_order(make_update):
+    async def scenario():
+        processor = main.ChatOrderedUpdateProcessor(concurrency=4)
+        log = []
+        # Первый апдейт самый долгий - без очереди чата он закончился бы последним
+        await asyncio.gather(*(
+            processor.do_process_update(make_update(i, 1, f"сообщение {i}"), record(log, i, delay))
+            for i, delay in enumerate((0.05, 0.02, 0))
+        ))
+        return log
+
+    log = asyncio.run(scenario())
+    assert log == [('start', 0), ('end', 0), ('start', 1), ('end', 1), ('start', 2), ('end', 2)]
+
+
+def test_different_chats_run_concurrently(make_update):
+    async def scenario():
+        processor = main.ChatOrderedUpdateProcessor(concurrency=4)
+        log = []
+        await asyncio.gather(
+            processor.do_process_update(make_update(1, 1, "долгий"), record(log, 'slow', 0.05)),
+            processor.do_process_update(make_update(2, 2, "быстрый"), record(log, 'fast')),
+        )
+        return log
+
+    log = asyncio.run(scenario())
+    assert log.index(('end', 'fast')) < log.index(('end', 'slow'))
+
+
+def test_fast_lane_bypasses_slots_and_chat_queue(make_update):
+    async def scenario():
+        processor = main.ChatOrderedUpdateProcessor(concurrency=1)
+        log = []
+        release = asyncio.Event()
+
+        async def blocking():
+            log.append(('start', 'llm'))
+            await release.wait()
+            log.append(('end', 'llm'))
+
+        slow = asyncio.create_task(processor.do_process_update(make_update(1, 1, "вопрос"), blocking()))
+        queued = asyncio.create_task(processor.do_process_update(make_update(2, 2, "вопрос"), record(log, 'queued')))
+        await asyncio.sleep(0.01)
+        # Единственный слот занят, а /help того же чата не ждёт ни слота, ни очереди
+        await asyncio.wait_for(
+            processor.do_process_update(make_update(3, 1, "/help"), record(log, 'help')), timeout=1
+        )
+        release.set()
+        await asyncio.gather(slow, queued)
+        return log
+
+    log = asyncio.run(scenario())
+    assert log.index(('end', 'help')) < log.index(('end', 'llm'))
+    assert ('start', 'queued') not in log[:log.index(('end', 'llm'))]
+
+
+def test_is_fast_parses_commands(make_update):
+    processor = main.ChatOrderedUpdateProcessor()
+    assert processor.is_fast(make_update(1, 1, "/help"))
+    assert processor.is_fast(make_update(2, 1, "/Models@some_bot"))
+    assert not processor.is_fast(make_update(3, 1, "/voice привет"))
+    assert not processor.is_fast(make_update(4, 1, "help"))
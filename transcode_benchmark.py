@@ -0,0 +1,128 @@
+"""Микробенчмарк перекодирования ответа /voice: MP3 от gTTS -> OGG.
+
+Сравнивает три способа на одном и том же MP3:
+    pydub       - как раньше: AudioSegment.from_mp3 + export в пуле процессов
+    ffmpeg-cold - один ffmpeg на запрос, запускается на пути ответа
+    ffmpeg-warm - OpusEncoderPool из main.py с заранее запущенными ffmpeg
+
+Входной MP3 берётся из --input или генерируется самим ffmpeg (синус
+заданной длины), поэтому сеть не нужна. Нужен ffmpeg с libopus и libmp3lame.
+
+Пример:
+    python transcode_benchmark.py --iterations 50 --concurrency 2 --output transcode.json
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import subprocess
+
+from benchmark import percentiles
+
+MODES = ('pydub', 'ffmpeg-cold', 'ffmpeg-warm')
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Сравнение способов перекодирования MP3 в OGG")
+    parser.add_argument('--input', help="MP3-файл; по умолчанию генерируется")
+    parser.add_argument('--seconds', type=float, default=8.0, help="Длина сгенерированного MP3, с")
+    parser.add_argument('--iterations', type=int, default=30, help="Перекодирований на способ")
+    parser.add_argument('--concurrency', type=int, default=1, help="Одновременных перекодирований")
+    parser.add_argument('--workers', type=int, default=2, help="Процессов в пуле pydub и тёплых ffmpeg")
+    parser.add_argument('--modes', default=','.join(MODES), help="Способы через запятую")
+    parser.add_argument('--ffmpeg', default=os.getenv('FFMPEG_BINARY', 'ffmpeg'))
+    parser.add_argument('--output', default='transcode_report.json', help="Файл JSON-отчёта")
+    return parser.parse_args(argv)
+
+def load_input(args) -> bytes:
+    if args.input:
+        with open(args.input, 'rb') as f:
+            return f.read()
+    # Речь gTTS - моно MP3 24 кГц, генерируем похожий
+    return subprocess.run(
+        [args.ffmpeg, '-hide_banner', '-loglevel', 'error',
+         '-f', 'lavfi', '-i', f"sine=frequency=440:duration={args.seconds}",
+         '-ac', '1', '-ar', '24000', '-c:a', 'libmp3lame', '-b:a', '32k', '-f', 'mp3', 'pipe:1'],
+        check=True, capture_output=True
+    ).stdout
+
+async def run_mode(mode: str, mp3_data: bytes, args, main) -> dict:
+    loop = asyncio.get_running_loop()
+    pool = None
+    encoder = None
+    if mode == 'pydub':
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=args.workers)
+        # Процессы пула поднимаем заранее - как после прогрева бота
+        await asyncio.gather(*(loop.run_in_executor(pool, main._warm_transcoder) for _ in range(args.workers)))
+
+        async def transcode():
+            return await loop.run_in_executor(pool, main._transcode_to_ogg, mp3_data)
+    else:
+        encoder = main.OpusEncoderPool(size=args.workers if mode == 'ffmpeg-warm' else 0, binary=args.ffmpeg)
+        await encoder.fill()
+
+        async def transcode():
+            return await encoder.transcode(mp3_data)
+
+    latencies = []
+    sizes = []
+    remaining = args.iterations
+
+    async def runner():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            sizes.append(len(await transcode()))
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(runner() for _ in range(args.concurrency)))
+    finally:
+        elapsed = time.perf_counter() - started
+        if pool is not None:
+            pool.shutdown()
+        if encoder is not None:
+            await encoder.close()
+
+    return {
+        'latency_seconds': percentiles(latencies),
+        'throughput_per_second': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'output_bytes': sizes[0] if sizes else 0,
+        'cold_starts': encoder.cold_starts if encoder is not None else None
+    }
+
+async def run_transcode_benchmark(args) -> dict:
+    os.environ['FFMPEG_BINARY'] = args.ffmpeg
+    import main
+
+    mp3_data = load_input(args)
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'input_bytes': len(mp3_data),
+        'modes': {}
+    }
+    for mode in args.modes.split(','):
+        if mode not in MODES:
+            raise SystemExit(f"Неизвестный способ: {mode}")
+        report['modes'][mode] = await run_mode(mode, mp3_data, args, main)
+    return report
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(run_transcode_benchmark(args))
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    for mode, result in report['modes'].items():
+        latency = result['latency_seconds']
+        print(f"⏱ {mode}: p50={latency.get('p50')} p95={latency.get('p95')} c, "
+              f"{result['throughput_per_second']}/c, {result['output_bytes']} байт")
+    print(f"📄 Отчёт: {args.output}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())